@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Benchmark the api_models Lambda against moto's in-memory S3, STS and Sagemaker so listing latency and copy throughput
+# regressions show up before an event. Run from the repository root:
+#   pip install -r functions/api_models/requirements.txt -r benchmark/requirements.txt
+#   python benchmark/api_models_benchmark.py [model counts...]
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from contextlib import contextmanager, redirect_stdout
+
+# The Lambda reads its configuration from the environment when it is imported, and must never reach real AWS from here
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_SECURITY_TOKEN': 'testing',
+    'AWS_SESSION_TOKEN': 'testing',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_XRAY_SDK_ENABLED': 'false',
+    'DESTINATION_BUCKET': 'benchmark-destination'
+})
+import boto3
+try:
+    from moto import mock_aws
+except ImportError:
+    # moto releases before 5.0 mock each service separately
+    from moto import mock_s3, mock_sagemaker, mock_sts
+    @contextmanager
+    def mock_aws():
+        with mock_s3(), mock_sts(), mock_sagemaker():
+            yield
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'api_models'))
+import app
+
+# Model counts of the synthetic accounts, overridden by the command line arguments
+model_counts = [int(n) for n in sys.argv[1:]] or [10, 100, 1000]
+# Number of times each listing is repeated
+repeats = int(os.environ.get('BENCHMARK_REPEATS', '5'))
+# Size of the model artifact copied by the copy benchmark
+copy_size_mb = int(os.environ.get('BENCHMARK_COPY_SIZE_MB', '64'))
+account = '123456789012'
+# Racers' roles are in their own accounts, so the function normally runs in a different account and streams the copy
+function_account = '210987654321'
+role_arn = f'arn:aws:iam::{account}:role/DeepRacerUploader'
+source_bucket = f'aws-deepracer-{uuid.uuid4()}'
+
+class Context(object):
+    function_name = 'benchmark'
+    def __init__(self, function_account=function_account):
+        self.invoked_function_arn = f'arn:aws:lambda:us-east-1:{function_account}:function:benchmark'
+
+def create_account(count):
+    # A Deep Racer bucket holding one model artifact per training job, as written by the Deep Racer console
+    s3 = boto3.client('s3')
+    sagemaker = boto3.client('sagemaker')
+    s3.create_bucket(Bucket=os.environ['DESTINATION_BUCKET'])
+    s3.create_bucket(Bucket=source_bucket)
+    for i in range(count):
+        job_name = f'dr-sm-rltj--{i:05d}'
+        sagemaker.create_training_job(
+            TrainingJobName = job_name,
+            HyperParameters = {'reward_function_s3_source': f's3://{source_bucket}/reward-functions/Model-{i:05d}/reward_function.py'},
+            AlgorithmSpecification = {'TrainingImage': 'deepracer', 'TrainingInputMode': 'File'},
+            RoleArn = role_arn,
+            OutputDataConfig = {'S3OutputPath': f's3://{source_bucket}/'},
+            ResourceConfig = {'InstanceType': 'ml.c5.2xlarge', 'InstanceCount': 1, 'VolumeSizeInGB': 30},
+            StoppingCondition = {'MaxRuntimeInSeconds': 3600}
+        )
+        s3.put_object(Bucket=source_bucket, Key=f'DeepRacer-SageMaker-rlmdl-{account}-{i:05d}/{job_name}/output/model.tar.gz', Body=b'model')
+    # Every other model has already been uploaded
+    for i in range(0, count, 2):
+        s3.put_object(Bucket=os.environ['DESTINATION_BUCKET'], Key=f'Model-{i:05d}-{account}-us-east-1.tar.gz', Body=b'model')
+
+def invoke(event, context=None):
+    # Call the handler and collect the embedded metric documents it logs
+    output = io.StringIO()
+    start = time.time()
+    with redirect_stdout(output):
+        response = app.lambda_handler(event, context or Context())
+    elapsed = (time.time() - start) * 1000
+    stages = {}
+    for line in output.getvalue().splitlines():
+        if line.startswith('{"_aws"'):
+            document = json.loads(line)
+            for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']:
+                stages.setdefault(metric['Name'], []).extend(document[metric['Name']])
+    return response, elapsed, stages
+
+def list_models(refresh):
+    return invoke({
+        'resource': '/models',
+        'queryStringParameters': {'RoleArn': role_arn, 'Region': 'us-east-1', 'refresh': str(refresh).lower()}
+    })
+
+def report(name, timings, stages):
+    print(f'  {name}: median {statistics.median(timings):.1f} ms, max {max(timings):.1f} ms')
+    for stage, values in stages.items():
+        if stage in ['Latency', 'Models', 'CatalogMisses']:
+            continue
+        print(f'    {stage}: {len(values)} x {statistics.mean(values):.2f} {"MB/s" if stage == "CopyThroughput" else "ms"} (total {sum(values):.1f})')
+
+def benchmark(count):
+    print(f'{count} models')
+    create_account(count)
+    # A full rebuild describes every training job, a warm listing only reads the catalog snapshot
+    for name, refresh in [('Listing with catalog rebuild', True), ('Listing from catalog', False)]:
+        timings = []
+        stages = {}
+        for _ in range(repeats):
+            response, elapsed, run_stages = list_models(refresh)
+            assert response['statusCode'] == 200, response
+            assert json.loads(response['body'])['total'] == count
+            timings.append(elapsed)
+            for stage, values in run_stages.items():
+                stages.setdefault(stage, []).extend(values)
+        report(name, timings, stages)
+
+def benchmark_copy():
+    print(f'Copy of a {copy_size_mb} MB model')
+    boto3.client('s3').put_object(Bucket=source_bucket, Key='DeepRacer-SageMaker-rlmdl-copy/dr-sm-rltj--copy/output/model.tar.gz', Body=os.urandom(copy_size_mb * 1024 * 1024))
+    # A racer's model is streamed across accounts, and only a role in the function's own account gets a server side copy
+    for name, context in [('Cross account copy job', Context()), ('Same account copy job', Context(account))]:
+        job = {
+            'JobId': str(uuid.uuid4()),
+            'State': 'PENDING',
+            'RoleArn': role_arn,
+            'Region': 'us-east-1',
+            'Source': f's3://{source_bucket}/DeepRacer-SageMaker-rlmdl-copy/dr-sm-rltj--copy/output/model.tar.gz',
+            'DestinationKey': f'Copy-{account}-us-east-1.tar.gz',
+            'BytesCopied': 0,
+            'TotalBytes': None
+        }
+        # Remove the stored blob so that the second job copies it again rather than finding a duplicate
+        for o in boto3.client('s3').list_objects_v2(Bucket=os.environ['DESTINATION_BUCKET'], Prefix=app.BLOB_PREFIX).get('Contents', []):
+            boto3.client('s3').delete_object(Bucket=os.environ['DESTINATION_BUCKET'], Key=o['Key'])
+        response, elapsed, stages = invoke({'CopyJob': job}, context)
+        assert response['State'] == 'SUCCEEDED', response
+        report(name, [elapsed], stages)
+
+def main():
+    for count in model_counts:
+        # Each account size gets fresh mocked services and empty Lambda caches
+        with mock_aws():
+            app.credential_cache.clear()
+            app.client_cache.clear()
+            app.thread_local.__dict__.clear()
+            benchmark(count)
+            if count == model_counts[-1]:
+                benchmark_copy()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+remoteSrc = os.environ.get('REMOTE_SRC', '192.168.1.250')
+remoteUsr = os.environ.get('REMOTE_USR', 'pi')
+remoteDir = os.environ.get('REMOTE_DIR', '/dr_models/')
+destDir = os.environ.get('DEST_DIR', '/home/pi/dr_models/')
+# Change feed served by the Greengrass sync function
+feedUrl = os.environ.get('FEED_URL', f'http://{remoteSrc}:8080/changes')
+# File holding the last sequence number applied so that a restart only pulls newer changes
+stateFile = os.environ.get('STATE_FILE', os.path.join(destDir, '.model_sync_state'))
+# Bandwidth limit passed to rsync in KB/s (0 for no limit)
+bwLimit = int(os.environ.get('BW_LIMIT', '2000'))
+loopDur = int(os.environ.get('LOOP_DUR', '30'))
+# The car must have had no web connections and a load average below this for idleDur seconds before any work is done
+idleDur = int(os.environ.get('IDLE_DUR', '60'))
+idleLoad = float(os.environ.get('IDLE_LOAD', '1.5'))
+httpPorts = [int(p) for p in os.environ.get('HTTP_PORTS', '80,443').split(',')]
+# Identical models are held once in this folder, as on the Greengrass device, and the model files are hard links to them
+blobDir = os.path.join(destDir, '.blobs')
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+
+def established_http_connections():
+    # Count ESTABLISHED TCP connections to the car's web server straight from the kernel tables
+    count = 0
+    for table in ['/proc/net/tcp', '/proc/net/tcp6']:
+        if not os.path.exists(table):
+            continue
+        with open(table) as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                local_port = int(fields[1].split(':')[1], 16)
+                # State 01 is ESTABLISHED
+                if fields[3] == '01' and local_port in httpPorts:
+                    count += 1
+    return count
+
+def is_busy():
+    connections = established_http_connections()
+    load = os.getloadavg()[0]
+    if connections > 0 or load > idleLoad:
+        logger.info(f'Car is busy ({connections} http connections, load average {load:.2f}).')
+        return True
+    return False
+
+def read_state():
+    if os.path.exists(stateFile):
+        with open(stateFile) as f:
+            return int(f.read().strip() or 0)
+    return 0
+
+def write_state(sequence):
+    with open(f'{stateFile}.tmp', 'w') as f:
+        f.write(str(sequence))
+    os.replace(f'{stateFile}.tmp', stateFile)
+
+def fetch_changes(since):
+    with urllib.request.urlopen(f'{feedUrl}?since={since}', timeout=30) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+def local_models():
+    models = set()
+    for root, folders, files in os.walk(destDir):
+        folders[:] = [f for f in folders if os.path.join(root, f) != blobDir]
+        for name in files:
+            if name.endswith('.tar.gz'):
+                models.add(os.path.relpath(os.path.join(root, name), destDir))
+    return models
+
+def plan(feed):
+    # Work out which models to pull and which to remove. A reset feed is the full manifest so anything not in it is removed.
+    pull = {}
+    remove = set()
+    for change in feed['Changes']:
+        if change['Op'] == 'put':
+            pull[change['Key']] = change
+            remove.discard(change['Key'])
+        elif change['Op'] == 'delete':
+            pull.pop(change['Key'], None)
+            remove.add(change['Key'])
+    present = local_models()
+    if feed['Reset']:
+        remove |= present - set(pull.keys())
+        # Models already present with the right size do not need transferring again
+        pull = {k: v for k, v in pull.items() if k not in present or os.path.getsize(os.path.join(destDir, k)) != v['Size']}
+    return pull, remove
+
+def pull_models(keys):
+    # Transfer only the listed files. Models are already compressed tarballs so rsync compression is not used.
+    listing = f'{stateFile}.files'
+    with open(listing, 'w') as f:
+        f.write('\n'.join(keys) + '\n')
+    command = ['rsync', '-rPv', f'--files-from={listing}', f'--bwlimit={bwLimit}', f'{remoteUsr}@{remoteSrc}:{remoteDir}', destDir]
+    logger.info(f'Pulling {len(keys)} files...')
+    subprocess.run(command, check=True)
+    os.remove(listing)
+
+def link_file(blob_path, path):
+    # Hard link the model name to its blob, replacing any existing file atomically
+    if os.path.exists(path) and os.path.samefile(blob_path, path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(f'{path}.link'):
+        os.remove(f'{path}.link')
+    os.link(blob_path, f'{path}.link')
+    os.replace(f'{path}.link', path)
+
+def prune_blobs():
+    # A blob with no other links is no longer used by any model
+    if os.path.exists(blobDir):
+        for name in os.listdir(blobDir):
+            path = os.path.join(blobDir, name)
+            if os.stat(path).st_nlink == 1:
+                logger.info(f'Removing unused blob {name}')
+                os.remove(path)
+
+def fetch_models(pull):
+    # Each blob is transferred once however many models refer to it, and not at all if it is already held
+    blobs = {c['Blob'] for c in pull.values() if c.get('Blob') and not os.path.exists(os.path.join(destDir, c['Blob']))}
+    files = sorted([k for k, c in pull.items() if not c.get('Blob')] + list(blobs))
+    if len(files) > 0:
+        pull_models(files)
+    for key, change in pull.items():
+        if change.get('Blob'):
+            link_file(os.path.join(destDir, change['Blob']), os.path.join(destDir, key))
+
+def prefetch(feed, pull):
+    # Pull the models of the racers who are up next one at a time in the order they are needed, before anything else
+    for key in feed.get('UpNext', []):
+        if key in pull:
+            logger.info(f'Prefetching up next model {key}')
+            fetch_models({key: pull.pop(key)})
+
+def sync(priority_only=False):
+    since = read_state()
+    feed = fetch_changes(since)
+    if priority_only:
+        # Only fetch up next models that are missing. Nothing else is applied so the sequence number is left as it is.
+        pull, _ = plan(dict(feed, Reset=True))
+        prefetch(feed, {k: v for k, v in pull.items() if k in feed.get('UpNext', [])})
+        return
+    if feed['Sequence'] == since and not feed['Reset']:
+        logger.info(f'No changes since sequence {since}.')
+        return
+    # The first sync compares the whole folder, since it may hold models copied by the old rsync loop
+    feed['Reset'] = feed['Reset'] or since == 0
+    pull, remove = plan(feed)
+    for key in remove:
+        path = os.path.join(destDir, key)
+        if os.path.exists(path):
+            logger.info(f'Removing {key}')
+            os.remove(path)
+    prefetch(feed, pull)
+    fetch_models(pull)
+    prune_blobs()
+    write_state(feed['Sequence'])
+    logger.info(f'Sync complete to sequence {feed["Sequence"]}.')
+
+def main():
+    os.makedirs(destDir, exist_ok=True)
+    idle_since = None
+    while True:
+        if is_busy():
+            idle_since = None
+        else:
+            idle_since = idle_since or time.time()
+            # Only sync once the car has been idle for the whole quiet period. Up next models are pulled as soon as the car is not busy.
+            try:
+                sync(priority_only=time.time() - idle_since < idleDur)
+            except Exception as e:
+                logger.error(f'Sync failed: {e}')
+        time.sleep(loopDur)
+
+if __name__ == '__main__':
+    main()
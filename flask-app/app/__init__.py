@@ -7,11 +7,20 @@ from aws_xray_sdk.ext.flask.middleware import XRayMiddleware
 from config import Config
 from flask_babel import Babel
 from flask_bootstrap import Bootstrap
+from app.backend import BackendClient
+from app.rendering import PageCache, build_icon_sprite, compress_response, icon_references
+from app.s3upload import StreamingRequest
 
 app = Flask(__name__)
+app.request_class = StreamingRequest
 app.config.from_object(Config)
 bootstrap = Bootstrap(app)
 babel = Babel(app)
+page_cache = PageCache(app.config['PAGE_CACHE_SIZE'])
+# Icons are served once as a cacheable sprite and referenced from the pages
+icon_sprite, icon_version, icon_attributes = build_icon_sprite(app.config['WEB_ICONS'])
+icons = icon_references(icon_attributes, f'/icons.svg?v={icon_version}')
+backend = BackendClient(app.config['WEBSERVICE_ENDPOINT'], app.config['API_KEY'], app.config['BACKEND_TIMEOUT'], app.config['BACKEND_RETRIES'], app.config['BACKEND_POOL_SIZE'])
 xray_recorder.configure(service='flask-app', plugins=('ElasticBeanstalkPlugin', 'EC2Plugin', 'ECSPlugin'))
 XRayMiddleware(app, xray_recorder)
 patch_all()
@@ -31,4 +40,8 @@ if not app.debug:
 def get_locale():
     return request.accept_languages.best_match(app.config['LANGUAGES'])
 
+@app.after_request
+def compress(response):
+    return compress_response(response, request.headers.get('Accept-Encoding', ''))
+
 from app import errors, routes
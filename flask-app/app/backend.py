@@ -0,0 +1,40 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class BackendClient(object):
+    # Shared client for the API Gateway backend. Connections are kept alive and pooled across requests and worker threads,
+    # every call has a timeout, and idempotent calls are retried a limited number of times when the backend throttles or is unavailable.
+    # Gateway errors (502, 504) are not retried since the backend may still be doing the work, e.g. a listing that ran past the
+    # API Gateway timeout, and repeating it would only keep the backend busy after the user has been given the error.
+    def __init__(self, endpoint, api_key, timeout, retries, pool_size):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.session = self.create_session(api_key, pool_size, Retry(
+            total = retries,
+            backoff_factor = 0.5,
+            status_forcelist = [429, 503],
+            allowed_methods = ['GET', 'DELETE'],
+            raise_on_status = False
+        ))
+        # Calls with side effects, such as the GET that starts a model upload, are sent through a session that never retries
+        self.single_session = self.create_session(api_key, pool_size, Retry(total=0, raise_on_status=False))
+
+    def create_session(self, api_key, pool_size, retry):
+        session = requests.Session()
+        session.headers.update({'x-api-key': api_key})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, path, params=None, retry=True):
+        session = self.session if retry else self.single_session
+        return session.get(f'{self.endpoint}{path}', params=params, timeout=self.timeout)
+
+    def post(self, path, params=None, json=None):
+        # POST is not retried since it may not be idempotent
+        return self.single_session.post(f'{self.endpoint}{path}', params=params, json=json, timeout=self.timeout)
+
+    def delete(self, path, params=None):
+        return self.session.delete(f'{self.endpoint}{path}', params=params, timeout=self.timeout)
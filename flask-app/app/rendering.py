@@ -0,0 +1,76 @@
+import gzip
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from flask import render_template, session
+from flask_wtf.csrf import generate_csrf
+
+# Stands in for the per-session csrf token in cached pages and is swapped for the real token when a page is served
+CSRF_PLACEHOLDER = '__CSRF_TOKEN_PLACEHOLDER__'
+# Responses of these types and at least this size are gzip compressed
+COMPRESS_MIMETYPES = ['text/html', 'text/css', 'text/javascript', 'application/javascript', 'application/json', 'image/svg+xml']
+COMPRESS_MIN_SIZE = 500
+
+def build_icon_sprite(icons):
+    # Turn the inline SVG icons into one SVG sprite of symbols plus small <svg><use/></svg> references to each symbol.
+    # The outer attributes (size, colour and class) stay on the reference so each icon looks the same as when inlined.
+    symbols = []
+    outer = {}
+    for name, svg in icons.items():
+        match = re.match(r'<svg([^>]*)>(.*)</svg>$', svg, re.S)
+        attributes = dict(re.findall(r'([\w:-]+)="([^"]*)"', match.group(1)))
+        symbols.append(f'<symbol id="{name}" viewBox="{attributes.pop("viewBox")}">{match.group(2)}</symbol>')
+        attributes.pop('xmlns', None)
+        outer[name] = ' '.join(f'{k}="{v}"' for k, v in attributes.items())
+    sprite = f'<svg xmlns="http://www.w3.org/2000/svg">{"".join(symbols)}</svg>'
+    version = hashlib.md5(sprite.encode('utf-8')).hexdigest()[:12]
+    return sprite, version, outer
+
+def icon_references(outer, url):
+    return {name: f'<svg {attributes}><use href="{url}#{name}"/></svg>' for name, attributes in outer.items()}
+
+class PageCache(object):
+    # Rendered pages keyed by template and language. Pages are only cached while there are no flashed messages to show,
+    # and the csrf token is replaced with a placeholder so that one cached page can be served to every session.
+    def __init__(self, size):
+        self.size = size
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def render(self, locale, template, **context):
+        if '_flashes' in session:
+            return render_template(template, **context)
+        key = (template, str(locale))
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+        if page is None:
+            token = generate_csrf()
+            page = render_template(template, **context).replace(token, CSRF_PLACEHOLDER)
+            with self.lock:
+                self.pages[key] = page
+                while len(self.pages) > self.size:
+                    self.pages.popitem(last=False)
+        return page.replace(CSRF_PLACEHOLDER, generate_csrf())
+
+def compress_response(response, accept_encoding):
+    # Gzip text responses for browsers that accept it
+    if (
+        'gzip' not in accept_encoding.lower()
+        or response.direct_passthrough
+        or response.status_code < 200
+        or response.status_code >= 300
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in COMPRESS_MIMETYPES
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Content-Length'] = str(len(response.get_data()))
+    response.vary.add('Accept-Encoding')
+    return response
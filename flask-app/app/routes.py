@@ -1,25 +1,36 @@
-import json
-import os
+import math
+import re
+import uuid
 import boto3
-import requests
 from aws_xray_sdk.core import patch_all
 from botocore.exceptions import ClientError
-from flask import flash, redirect, render_template, request, send_file, url_for
-from werkzeug.utils import secure_filename
+from flask import flash, make_response, redirect, render_template, request, send_file, url_for
 from flask_babel import _
-from app import app
+from flask_wtf.csrf import validate_csrf
+from wtforms.validators import ValidationError
+from app import app, backend, get_locale, icon_sprite, icon_version, icons, page_cache
 from app.forms import RoleForm, S3Form
 
 patch_all()
 
 @app.route('/', methods=['GET'])
 def index():
-    return render_template('index.html.j2', title='Deep Racer Model Uploader')
+    return page_cache.render(get_locale(), 'index.html.j2', title='Deep Racer Model Uploader')
 
 @app.route('/role', methods=['GET'])
 def role():
     form = RoleForm()
-    return render_template('role.html.j2', title='Deep Racer Model Uploader', form=form, account_id=app.config['AWS_ACCOUNT_ID'], region=app.config['AWS_REGION'], link_url=app.config['LINK_URL'])
+    return page_cache.render(get_locale(), 'role.html.j2', title='Deep Racer Model Uploader', form=form, account_id=app.config['AWS_ACCOUNT_ID'], region=app.config['AWS_REGION'], link_url=app.config['LINK_URL'])
+
+@app.route('/icons.svg', methods=['GET'])
+def icon_sprite_svg():
+    # The sprite url includes its version so it can be cached for a long time
+    response = make_response(icon_sprite)
+    response.mimetype = 'image/svg+xml'
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.set_etag(icon_version, weak=True)
+    return response.make_conditional(request)
 
 @app.route('/downloads/<path>')
 def downloadFile (path):
@@ -29,7 +40,17 @@ def downloadFile (path):
 def model():
     if 'rolearn' not in request.args:
         return redirect(url_for('role'))
-    response = requests.get(f"{app.config['WEBSERVICE_ENDPOINT']}/models?RoleArn={request.args.get('rolearn')}", headers={'x-api-key': app.config['API_KEY']})
+    params = {'RoleArn': request.args.get('rolearn')}
+    if 'region' in request.args:
+        params['Region'] = request.args.get('region')
+    if request.args.get('refresh', 'false').lower() == 'true':
+        params['refresh'] = 'true'
+    # Only the requested page of models is returned by the backend
+    params['Limit'] = app.config['MODEL_PAGE_SIZE']
+    for arg, param in [('prefix', 'Prefix'), ('sort', 'Sort'), ('order', 'Order'), ('cursor', 'Cursor')]:
+        if request.args.get(arg):
+            params[param] = request.args.get(arg)
+    response = backend.get('/models', params=params)
     if response.status_code != 200:
         if 'errorMessage' in response.json():
             flash(response.json()['errorMessage'], category='danger')
@@ -37,16 +58,22 @@ def model():
             flash(response.json(), category='danger')
         return redirect(url_for('role'))
     models = response.json()['models']
-    print(json.dumps(models))
     models = [m.update({'id': n}) or m for n, m in enumerate(models)]
-    if len(models) == 0:
+    if response.json()['total'] == 0:
         flash(_('No Models were found. Please verify the account has Deep Racer models and the IAM role supplied has the correct permissions to access them.'), category='warning')
-    return render_template('model.html.j2', title='Deep Racer Model Uploader', icons=app.config['WEB_ICONS'], models=models)
+    # Link to the next page keeping the current filter and sort order
+    next_url = None
+    if response.json()['cursor']:
+        next_url = url_for('model', **dict(request.args.to_dict(), cursor=response.json()['cursor'], refresh='false'))
+    return render_template('model.html.j2', title='Deep Racer Model Uploader', icons=icons, models=models, total=response.json()['total'], next_url=next_url)
 
 @app.route('/s3', methods=['GET', 'POST'])
 def s3():
     form = S3Form()
+    job_id = None
     if form.validate_on_submit():
+        # The model file has already been streamed to a staging key by the request parser
+        upload = form.modelfile.data.stream
         if not form.modelfile.data.filename.endswith('.tar.gz'):
             flash(_('You selected a file with an invalid filename. Please ensure you select a downloaded model file with extension .tar.gz'), category='danger')
         else:
@@ -57,42 +84,210 @@ def s3():
                 flash(_('A model with the same name already exists, file upload cancelled.'), category='warning')
             except ClientError as e:
                 if e.response['Error']['Code'] == '404':
-                    form.modelfile.data.save(secure_filename(destination_key))
-                    with open(secure_filename(destination_key), 'rb') as f:
-                        boto3.client('s3').upload_fileobj(f, app.config['DESTINATION_BUCKET'], destination_key)
-                    os.remove(secure_filename(destination_key))
-                    flash(_('File successfully uploaded.'), category='success')
+                    # Complete the staged upload and have the backend store it with a copy job, which the page then polls
+                    upload.complete()
+                    response = backend.post('/uploads', json={'Key': upload.key, 'DestinationKey': destination_key})
+                    if response.status_code == 409:
+                        flash(_('A model with the same name already exists, file upload cancelled.'), category='warning')
+                    elif response.status_code != 202:
+                        raise Exception('API request did not return 202 status.')
+                    else:
+                        job_id = response.json()['JobId']
                 else:
                     raise e
-    return render_template('s3.html.j2', title='Deep Racer Model Uploader', form=form)
+    if request.method == 'GET':
+        return page_cache.render(get_locale(), 's3.html.j2', title='Deep Racer Model Uploader', form=form)
+    return render_template('s3.html.j2', title='Deep Racer Model Uploader', form=form, job_id=job_id)
+
+@app.route('/s3/multipart', methods=['POST'])
+def s3_multipart_start():
+    # Start a multipart upload to a staging key in the destination bucket and return presigned URLs the browser can PUT each part to
+    error = check_csrf()
+    if error:
+        return error
+    filename = request.form.get('filename', '')
+    accountid = request.form.get('accountid', '')
+    try:
+        size = int(request.form.get('size', '0'))
+    except ValueError:
+        size = 0
+    if not filename.endswith('.tar.gz'):
+        return {'message': _('You selected a file with an invalid filename. Please ensure you select a downloaded model file with extension .tar.gz'), 'category': 'danger'}, 400
+    if not re.match(r'^\d{12}$', accountid):
+        return {'message': _('Must be a valid AWS Account Id. (12 digits e.g. 123456789012)'), 'category': 'danger'}, 400
+    if size <= 0 or size > app.config['MAX_CONTENT_LENGTH']:
+        return {'message': _('The selected file is empty or too large.'), 'category': 'danger'}, 400
+    destination_key = f'{filename[:-7]}-{accountid}.tar.gz'
+    s3 = boto3.resource('s3')
+    try:
+        s3.Object(app.config['DESTINATION_BUCKET'], destination_key).metadata
+        return {'message': _('A model with the same name already exists, file upload cancelled.'), 'category': 'warning'}, 409
+    except ClientError as e:
+        if e.response['Error']['Code'] != '404':
+            raise e
+    # S3 allows at most 10000 parts so increase the part size for very large files
+    part_size = max(app.config['S3_UPLOAD_PART_SIZE_MB'] * 1024 * 1024, math.ceil(size / 10000))
+    # The model name is kept with the staged upload so that completing it needs no server side state
+    staging_key = f"{app.config['S3_UPLOAD_STAGING_PREFIX']}{uuid.uuid4()}"
+    upload_id = s3.meta.client.create_multipart_upload(Bucket=app.config['DESTINATION_BUCKET'], Key=staging_key, Metadata={'destination': destination_key})['UploadId']
+    urls = [
+        s3.meta.client.generate_presigned_url(
+            'upload_part',
+            Params = {'Bucket': app.config['DESTINATION_BUCKET'], 'Key': staging_key, 'UploadId': upload_id, 'PartNumber': part_number},
+            ExpiresIn = app.config['S3_UPLOAD_URL_EXPIRY']
+        )
+        for part_number in range(1, math.ceil(size / part_size) + 1)
+    ]
+    return {'key': staging_key, 'upload_id': upload_id, 'part_size': part_size, 'urls': urls}
+
+@app.route('/s3/multipart/complete', methods=['POST'])
+def s3_multipart_complete():
+    error = check_csrf() or check_multipart_upload()
+    if error:
+        return error
+    s3 = boto3.client('s3')
+    # The presigned part URLs do not limit the size of each part, so check the parts S3 actually holds and complete the upload
+    # from that list so that no part can be swapped for a larger one in between
+    parts = []
+    for page in s3.get_paginator('list_parts').paginate(Bucket=app.config['DESTINATION_BUCKET'], Key=request.form['key'], UploadId=request.form['upload_id']):
+        parts.extend(page.get('Parts', []))
+    if len(parts) == 0 or sum(p['Size'] for p in parts) > app.config['MAX_CONTENT_LENGTH']:
+        s3.abort_multipart_upload(Bucket=app.config['DESTINATION_BUCKET'], Key=request.form['key'], UploadId=request.form['upload_id'])
+        return {'message': _('The selected file is empty or too large.'), 'category': 'danger'}, 400
+    s3.complete_multipart_upload(
+        Bucket = app.config['DESTINATION_BUCKET'],
+        Key = request.form['key'],
+        UploadId = request.form['upload_id'],
+        MultipartUpload = {'Parts': [{'PartNumber': p['PartNumber'], 'ETag': p['ETag']} for p in parts]}
+    )
+    # The content never passed through the server, so the backend hashes and stores it with a copy job rather than this request reading it back
+    destination_key = s3.head_object(Bucket=app.config['DESTINATION_BUCKET'], Key=request.form['key'])['Metadata']['destination']
+    response = backend.post('/uploads', json={'Key': request.form['key'], 'DestinationKey': destination_key})
+    if response.status_code == 409:
+        return {'message': _('A model with the same name already exists, file upload cancelled.'), 'category': 'warning'}, 409
+    if response.status_code != 202:
+        raise Exception('API request did not return 202 status.')
+    # The page polls the copy job and only reports the upload as successful once the model has been stored
+    return {'message': 'Model upload started.', 'job_id': response.json()['JobId']}
+
+@app.route('/s3/multipart/abort', methods=['POST'])
+def s3_multipart_abort():
+    error = check_csrf() or check_multipart_upload()
+    if error:
+        return error
+    boto3.client('s3').abort_multipart_upload(Bucket=app.config['DESTINATION_BUCKET'], Key=request.form['key'], UploadId=request.form['upload_id'])
+    return {'message': 'Upload aborted.'}
+
+def check_csrf():
+    # The multipart endpoints are called from javascript so validate the form's csrf token here rather than through a FlaskForm
+    try:
+        validate_csrf(request.form.get('csrf_token'))
+    except ValidationError as e:
+        return {'message': str(e), 'category': 'danger'}, 400
+
+def check_multipart_upload():
+    # Only allow completing or aborting staged model uploads that are actually in progress
+    if not re.match(rf"^{re.escape(app.config['S3_UPLOAD_STAGING_PREFIX'])}[0-9a-f-]{{36}}$", request.form.get('key', '')):
+        return {'message': _('Upload not found.'), 'category': 'danger'}, 404
+    try:
+        boto3.client('s3').list_parts(Bucket=app.config['DESTINATION_BUCKET'], Key=request.form['key'], UploadId=request.form.get('upload_id', ''), MaxParts=1)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchUpload':
+            return {'message': _('Upload not found.'), 'category': 'danger'}, 404
+        raise e
+
+@app.teardown_request
+def abort_s3_uploads(exception=None):
+    # Abort any staged uploads that were not completed, e.g. because the form was invalid or the model already exists
+    for upload in getattr(request, 's3_uploads', []):
+        upload.abort()
 
 @app.route('/action', methods=['POST'])
 def model_action():
-    request_url = f"{app.config['WEBSERVICE_ENDPOINT']}/models/{request.form['model_id']}?RoleArn={request.form['role_arn']}"
+    request_path = f"/models/{request.form['model_id']}"
+    params = {'RoleArn': request.form['role_arn']}
     if request.form['action'] == 'Upload':
-        response = requests.get(request_url, headers={'x-api-key': app.config['API_KEY']})
-        status_title = _('Model is present')
-        status_icon = app.config['WEB_ICONS']['tick']
-        action_title = _('Delete')
-        action_icon = app.config['WEB_ICONS']['delete']
+        # Each GET starts a copy job so it must not be retried
+        response = backend.get(request_path, params=params, retry=False)
     elif request.form['action'] == 'Delete':
-        response = requests.delete(request_url, headers={'x-api-key': app.config['API_KEY']})
-        status_title = _('Model is not present')
-        status_icon = app.config['WEB_ICONS']['cross']
-        action_title = _('Upload')
-        action_icon = app.config['WEB_ICONS']['upload']
-    if response.status_code != 200:
+        response = backend.delete(request_path, params=params)
+    # Uploads are accepted as an asynchronous copy job (202) that the page then polls
+    if response.status_code not in [200, 202]:
         raise Exception('API request did not return 200 status.')
     print(response.status_code)
     print(response.json())
     if response.json()['message'] in ['Model deleted.', 'Model uploaded.']:
-        status_html = f'<span data-toggle="tooltip" title="{status_title}">{status_icon}</span>'
-        action_html = f"<a data-toggle=\"tooltip\" title=\"{action_title} model\" href=\"javascript:modelAction(\'{request.form['id']}\', \'{action_title}\', \'{request.form['model_id']}\');\">{action_icon}</a>"
+        status_html, action_html = model_status_html(request.form['id'], request.form['model_id'], response.json()['message'] == 'Model uploaded.')
     else:
         status_html = ''
         action_html = ''
     return {
         'message': response.json()['message'],
+        'job_id': response.json().get('JobId'),
+        'status_html': status_html,
+        'action_html': action_html
+    }
+
+@app.route('/action/batch', methods=['POST'])
+def model_batch_action():
+    # Upload or delete several models with a single backend call
+    ids = request.form.getlist('ids[]')
+    model_ids = request.form.getlist('model_ids[]')
+    response = backend.post('/models/batch', params={'RoleArn': request.form['role_arn']}, json={'Action': request.form['action'], 'Models': model_ids})
+    if response.status_code != 200:
+        raise Exception('API request did not return 200 status.')
+    results = []
+    for id, result in zip(ids, response.json()['results']):
+        if result.get('message') in ['Model deleted.', 'Model uploaded.']:
+            status_html, action_html = model_status_html(id, result['Model'], result['message'] == 'Model uploaded.')
+        else:
+            status_html = ''
+            action_html = ''
+        results.append({
+            'id': id,
+            'model_id': result['Model'],
+            'message': result.get('message', result.get('errorMessage')),
+            'job_id': result.get('JobId'),
+            'status_html': status_html,
+            'action_html': action_html
+        })
+    return {'results': results}
+
+@app.route('/action/<job_id>', methods=['GET'])
+def model_action_status(job_id):
+    response = backend.get(f'/jobs/{job_id}')
+    if response.status_code != 200:
+        raise Exception('API request did not return 200 status.')
+    job = response.json()
+    # The row of the model list is only updated when the job was started from the list
+    if job['State'] == 'SUCCEEDED' and 'id' in request.args:
+        status_html, action_html = model_status_html(request.args['id'], request.args['model_id'], True)
+    else:
+        status_html = ''
+        action_html = ''
+    return {
+        'state': job['State'],
+        'bytes_copied': job['BytesCopied'],
+        'total_bytes': job['TotalBytes'],
+        'message': job.get('Message', ''),
         'status_html': status_html,
         'action_html': action_html
     }
+
+def model_status_html(id, model_id, uploaded):
+    # Build the status and action cells of a model row after an upload or delete
+    if uploaded:
+        status_title = _('Model is present')
+        status_icon = icons['tick']
+        action = 'Delete'
+        action_title = _('Delete model')
+        action_icon = icons['delete']
+    else:
+        status_title = _('Model is not present')
+        status_icon = icons['cross']
+        action = 'Upload'
+        action_title = _('Upload model')
+        action_icon = icons['upload']
+    status_html = f'<span data-toggle="tooltip" title="{status_title}">{status_icon}</span>'
+    action_html = f"<a data-toggle=\"tooltip\" title=\"{action_title}\" href=\"javascript:modelAction(\'{id}\', \'{action}\', \'{model_id}\');\">{action_icon}</a>"
+    return status_html, action_html
@@ -0,0 +1,90 @@
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+
+class S3MultipartWriter(object):
+    # File-like object that streams everything written to it into an S3 multipart upload, uploading parts in parallel while the
+    # request body is still being read. At most concurrency + 1 parts are held in memory at any time.
+    def __init__(self, bucket, key, part_size, concurrency, max_size=None):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_size = max_size
+        self.client = boto3.client('s3')
+        self.upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.slots = threading.BoundedSemaphore(concurrency + 1)
+        self.buffer = bytearray()
+        self.futures = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestEntityTooLarge()
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self.submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def submit(self, data):
+        # Block while the maximum number of parts are in flight so that memory stays bounded
+        self.slots.acquire()
+        part_number = len(self.futures) + 1
+        self.futures.append(self.executor.submit(self.upload_part, part_number, data))
+
+    def upload_part(self, part_number, data):
+        try:
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self.slots.release()
+
+    def seek(self, offset, whence=0):
+        # The form parser rewinds the stream once it has finished writing to it. Nothing can be read back so this is a no-op.
+        return 0
+
+    def tell(self):
+        return self.size
+
+    def complete(self):
+        # Upload the remaining buffer as the last part and complete the upload
+        if len(self.buffer) > 0 or len(self.futures) == 0:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        parts = [f.result() for f in self.futures]
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+        self.close()
+
+    def abort(self):
+        if not self.closed:
+            self.executor.shutdown(wait=True)
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.closed = True
+
+class StreamingRequest(Request):
+    # Request class that streams uploaded model files straight to a staging key in S3 instead of spooling them to disk
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.path == '/s3' and filename is not None:
+            config = current_app.config
+            writer = S3MultipartWriter(
+                config['DESTINATION_BUCKET'],
+                f"{config['S3_UPLOAD_STAGING_PREFIX']}{uuid.uuid4()}",
+                config['S3_UPLOAD_PART_SIZE_MB'] * 1024 * 1024,
+                config['S3_UPLOAD_CONCURRENCY'],
+                config['MAX_CONTENT_LENGTH']
+            )
+            if not hasattr(self, 's3_uploads'):
+                self.s3_uploads = []
+            self.s3_uploads.append(writer)
+            return writer
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
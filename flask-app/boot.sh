@@ -1,3 +1,5 @@
 #!/bin/sh
 source venv/bin/activate
-exec gunicorn -b :5000 --access-logfile - --error-logfile - flask-app:app
\ No newline at end of file
+# Threaded workers by default so that one container can serve many racers while requests wait on the backend.
+# Set GUNICORN_WORKER_CLASS=sync to go back to single threaded workers.
+exec gunicorn -b :5000 --worker-class ${GUNICORN_WORKER_CLASS:-gthread} --workers ${GUNICORN_WORKERS:-2} --threads ${GUNICORN_THREADS:-8} --access-logfile - --error-logfile - flask-app:app
\ No newline at end of file
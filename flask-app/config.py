@@ -14,4 +14,14 @@ class Config(object):
     AWS_REGION = os.environ.get('AWS_REGION')
     DESTINATION_BUCKET = os.environ.get('DESTINATION_BUCKET')
     LINK_URL = os.environ.get('LINK_URL')
+    PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', '64'))
+    MODEL_PAGE_SIZE = int(os.environ.get('MODEL_PAGE_SIZE', '50'))
+    MAX_CONTENT_LENGTH = int(os.environ.get('S3_UPLOAD_MAX_SIZE_MB', '1024')) * 1024 * 1024
+    S3_UPLOAD_CONCURRENCY = int(os.environ.get('S3_UPLOAD_CONCURRENCY', '4'))
+    S3_UPLOAD_PART_SIZE_MB = int(os.environ.get('S3_UPLOAD_PART_SIZE_MB', '8'))
+    S3_UPLOAD_URL_EXPIRY = int(os.environ.get('S3_UPLOAD_URL_EXPIRY', '3600'))
+    S3_UPLOAD_STAGING_PREFIX = os.environ.get('S3_UPLOAD_STAGING_PREFIX', 'uploads/')
     WEBSERVICE_ENDPOINT = os.environ.get('WEBSERVICE_ENDPOINT')
+    BACKEND_POOL_SIZE = int(os.environ.get('BACKEND_POOL_SIZE', '16'))
+    BACKEND_RETRIES = int(os.environ.get('BACKEND_RETRIES', '2'))
+    BACKEND_TIMEOUT = (float(os.environ.get('BACKEND_CONNECT_TIMEOUT', '3.05')), float(os.environ.get('BACKEND_READ_TIMEOUT', '30')))
@@ -1,66 +1,106 @@
+import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import boto3
-import re
+from babel.messages.pofile import read_po, write_po
+from botocore.config import Config
 
-translate = boto3.client('translate')
 translate_folder = './app/translations'
+source_language = 'en'
+# Translations already made are kept here keyed by target language and source text so that no string is sent twice
+memory_file = os.environ.get('TRANSLATION_MEMORY', f'{translate_folder}/translation_memory.json')
+# Number of strings translated in parallel across all languages
+concurrency = int(os.environ.get('TRANSLATE_CONCURRENCY', '8'))
+# Set TRANSLATOR=stub to fill the catalogs with marked up source text without calling Amazon Translate
+translator = os.environ.get('TRANSLATOR', 'aws')
 
-def translate_text(text, target, source='en'):
+# Adaptive retries back off and rate limit the client when Amazon Translate throttles requests
+translate = boto3.client('translate', config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'})) if translator == 'aws' else None
+memory_lock = threading.Lock()
+
+def translate_text(text, target, source=source_language):
   response = translate.translate_text(Text = text, SourceLanguageCode = source, TargetLanguageCode = target)
   return response['TranslatedText']
 
-def line_split(text, length=76):
-  if len(text) > 80:
-    match = re.search(r'(msgid|msgstr)\s\"([^\"]*)\"', text)
-    if match:
-      words = match.group(2).split(' ')
-      new_string = ''
-      line_string = ''
-      for word in words:
-        if (len(line_string) + len(word) + 1) > length:
-          new_string = new_string + '\n' + '"' + line_string + '"'
-          line_string = ' ' + word
-        else:
-          line_string = word if line_string == '' else line_string + ' ' + word
-      new_string = new_string + '\n' + '"' + line_string + '"'
-      return f'{match.group(1)} ""{new_string}'
-    else:
-      return text
-  else:
-    return text
+def stub_translate_text(text, target, source=source_language):
+  return f'[{target}] {text}'
+
+def load_memory():
+  if os.path.exists(memory_file):
+    with open(memory_file, mode='r', encoding='utf-8') as f:
+      return json.load(f)
+  return {}
+
+def save_memory(memory):
+  with open(f'{memory_file}.tmp', mode='w', encoding='utf-8') as f:
+    json.dump(memory, f, ensure_ascii=False, indent=2, sort_keys=True)
+  os.replace(f'{memory_file}.tmp', memory_file)
+
+def memoized_translate(memory, text, target):
+  with memory_lock:
+    cached = memory.get(target, {}).get(text)
+  if cached is not None:
+    return cached
+  if translator == 'stub':
+    # Placeholders are not remembered, otherwise a later real run would serve them instead of translating
+    return stub_translate_text(text, target)
+  translated = translate_text(text, target)
+  with memory_lock:
+    memory.setdefault(target, {})[text] = translated
+  return translated
+
+def needs_translation(message):
+  # New msgids have no translation yet and msgids changed since the last run are marked fuzzy by pybabel update
+  if not message.id:
+    return False
+  strings = message.string if isinstance(message.string, tuple) else (message.string,)
+  return message.fuzzy or not all(strings)
+
+def source_texts(message):
+  # Plural messages have one msgstr per plural form. The first is translated from the singular and the rest from the plural.
+  if isinstance(message.id, tuple):
+    return [message.id[0]] + [message.id[1]] * (len(message.string) - 1)
+  return [message.id]
+
+def load_catalogs():
+  catalogs = {}
+  for lang in sorted(os.listdir(translate_folder)):
+    path = f'{translate_folder}/{lang}/LC_MESSAGES/messages.po'
+    if os.path.exists(path):
+      with open(path, mode='rb') as f:
+        catalogs[lang] = read_po(f, locale=lang)
+  return catalogs
+
+def translate_catalogs(catalogs, memory):
+  # Each distinct source text is translated once per language, with the calls for every language made in parallel
+  pending = {}
+  for lang, catalog in catalogs.items():
+    messages = [m for m in catalog if needs_translation(m)]
+    print(f'Language folder: {lang} ({len(messages)} of {len(catalog)} messages to translate)')
+    for message in messages:
+      for text in source_texts(message):
+        pending[(lang, text)] = None
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    futures = {key: executor.submit(memoized_translate, memory, key[1], key[0]) for key in pending}
+  translations = {key: future.result() for key, future in futures.items()}
+  for lang, catalog in catalogs.items():
+    for message in catalog:
+      if needs_translation(message):
+        strings = [translations[(lang, text)] for text in source_texts(message)]
+        message.string = tuple(strings) if isinstance(message.id, tuple) else strings[0]
+        message.flags.discard('fuzzy')
 
-for lang in os.listdir(translate_folder):
-  print(f'Language folder: {lang}')
-  start_translating = False
-  if os.path.exists(f'{translate_folder}/{lang}/LC_MESSAGES/messages.po'):
-    f = open(f'{translate_folder}/{lang}/LC_MESSAGES/messages.po_new', mode='w', encoding='utf-8')
-    messages_content = open(f'{translate_folder}/{lang}/LC_MESSAGES/messages.po', mode='r', encoding='utf-8').read()
-    record_msg = False
-    mulitline_msg = ''
-    msgstr = ''
-    for line in messages_content.split('\n'):
-      if line.startswith('#:'):
-        start_translating = True
-      if start_translating:
-        if line == 'msgid ""':
-          record_msg = True
-          mulitline_msg = ''
-        elif line.startswith('msgid "'):
-          f.write(line_split(line) + '\n')
-          msgstr = translate_text(line[7:-1], lang)
-          f.write(line_split(f'msgstr "{msgstr}"') + '\n')
-        elif line.startswith('msgstr "'):
-          if record_msg and mulitline_msg != '':
-            msgstr = translate_text(mulitline_msg, lang)
-            f.write(line_split(f'msgid "{mulitline_msg}"') + '\n')
-            f.write(line_split(f'msgstr "{msgstr}"') + '\n')
-            msgstr = ''
-          record_msg = False
-        elif record_msg:
-          mulitline_msg += line[1:-1]
-        else:
-          if not(line.startswith('"') and line.endswith('"')):
-            f.write(line_split(line) + '\n')
-      else:
-          f.write(line_split(line) + '\n')
+def write_catalogs(catalogs):
+  for lang, catalog in catalogs.items():
+    with open(f'{translate_folder}/{lang}/LC_MESSAGES/messages.po_new', mode='wb') as f:
+      write_po(f, catalog, width=76)
 
+memory = load_memory()
+catalogs = load_catalogs()
+try:
+  translate_catalogs(catalogs, memory)
+finally:
+  # Keep whatever was translated even if a later call failed
+  save_memory(memory)
+write_catalogs(catalogs)
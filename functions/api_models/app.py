@@ -1,8 +1,19 @@
+import base64
+import hashlib
 import json
 import boto3
 import re
 import os
 import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from aws_xray_sdk.core import xray_recorder, patch_all
 
@@ -11,9 +22,181 @@ patch_all()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Number of training jobs to describe concurrently when listing models.
+LIST_CONCURRENCY = int(os.environ.get('LIST_CONCURRENCY', '8'))
+# Retry configuration for the Sagemaker client so that throttled describe calls back off and retry rather than fail the listing.
+SAGEMAKER_CONFIG = Config(
+    retries = {
+        'max_attempts': int(os.environ.get('SAGEMAKER_MAX_ATTEMPTS', '10')),
+        'mode': 'adaptive'
+    },
+    max_pool_connections = max(LIST_CONCURRENCY, 10)
+)
+# Transfer configuration for server side copies. Parts are copied in parallel by S3 so large parts and high concurrency cost the Lambda nothing.
+COPY_CONFIG = TransferConfig(
+    multipart_threshold = int(os.environ.get('COPY_PART_SIZE_MB', '64')) * 1024 * 1024,
+    multipart_chunksize = int(os.environ.get('COPY_PART_SIZE_MB', '64')) * 1024 * 1024,
+    max_concurrency = int(os.environ.get('COPY_CONCURRENCY', '10'))
+)
+# Transfer configuration for the streaming copy. The source body cannot be seeked so every part read ahead of the upload is buffered in memory.
+# max_in_memory_upload_chunks bounds that buffer (it defaults to 10 parts whatever the concurrency), so memory use is about part size x concurrency.
+STREAM_CONFIG = TransferConfig(
+    multipart_threshold = int(os.environ.get('STREAM_PART_SIZE_MB', '8')) * 1024 * 1024,
+    multipart_chunksize = int(os.environ.get('STREAM_PART_SIZE_MB', '8')) * 1024 * 1024,
+    max_concurrency = int(os.environ.get('STREAM_CONCURRENCY', '4'))
+)
+# boto3's TransferConfig does not take this as an argument but passes the attribute on to s3transfer
+STREAM_CONFIG.max_in_memory_upload_chunks = STREAM_CONFIG.max_request_concurrency
+# Regions a Region parameter may name. Unknown regions are rejected rather than each getting a discovery thread and client.
+SAGEMAKER_REGIONS = set(boto3.session.Session().get_available_regions('sagemaker'))
+# Maximum number of models accepted in one batch request.
+BATCH_LIMIT = int(os.environ.get('BATCH_LIMIT', '50'))
+# Prefix of the uploads staged in the destination bucket by the web app.
+UPLOAD_PREFIX = os.environ.get('UPLOAD_PREFIX', 'uploads/')
+# Models are stored once under this prefix, named by the MD5 of their content. The model name keys are small aliases pointing at the blob.
+BLOB_PREFIX = os.environ.get('BLOB_PREFIX', 'blobs/')
+# Minimum number of seconds between progress updates written to a copy job's status record.
+JOB_PROGRESS_INTERVAL = int(os.environ.get('JOB_PROGRESS_INTERVAL', '2'))
+# A job whose status record has not been updated for this many seconds is reported as failed. The function that ran it timed out or crashed.
+JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', str(30 * JOB_PROGRESS_INTERVAL)))
+# Maximum number of seconds a copy job's invocation may wait in the asynchronous invocation queue, matching the function's MaximumEventAgeInSeconds.
+JOB_MAX_EVENT_AGE = int(os.environ.get('JOB_MAX_EVENT_AGE', '21600'))
+# Credentials are reused across warm invocations until they are within this margin of their expiry.
+CREDENTIAL_EXPIRY_MARGIN = timedelta(seconds=int(os.environ.get('CREDENTIAL_EXPIRY_MARGIN', '300')))
+# Maximum number of roles (and role/region client pairs) kept in the caches before the least recently used entry is dropped.
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', '32'))
+# Module level caches survive between warm invocations of the Lambda.
+credential_cache = OrderedDict()
+client_cache = OrderedDict()
+cache_lock = threading.Lock()
+# boto3 resources are not thread safe so each worker thread keeps its own destination bucket resource and Lambda client.
+thread_local = threading.local()
+# Namespace of the per stage metrics written to the log in CloudWatch embedded metric format.
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'DeepRacerUploader')
+# Metric values recorded during the current invocation. Values are recorded from worker threads so access is locked.
+metrics = OrderedDict()
+metrics_lock = threading.Lock()
+
 def lambda_handler(event, context):
     print(json.dumps(event))
+    ResetMetrics()
+    start = time.time()
+    try:
+        return HandleEvent(event, context)
+    finally:
+        RecordMetric('Latency', (time.time() - start) * 1000)
+        FlushMetrics('CopyJob' if 'CopyJob' in event else event.get('resource', 'Unknown'))
+
+@contextmanager
+def Timer(name):
+    # Record the time taken by a block of code (or a decorated function) in milliseconds against the named metric
+    start = time.time()
     try:
+        yield
+    finally:
+        RecordMetric(name, (time.time() - start) * 1000)
+
+def RecordMetric(name, value, unit='Milliseconds'):
+    with metrics_lock:
+        metrics.setdefault(name, (unit, []))[1].append(value)
+
+def ResetMetrics():
+    with metrics_lock:
+        metrics.clear()
+
+def FlushMetrics(resource):
+    # Write the metrics recorded during this invocation to the log in CloudWatch embedded metric format so that CloudWatch extracts them.
+    # A metric can carry at most 100 values in one document, so metrics with more values are spread across several documents.
+    with metrics_lock:
+        recorded = OrderedDict((name, (unit, list(values))) for name, (unit, values) in metrics.items())
+        metrics.clear()
+    while len(recorded) > 0:
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Resource']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, _) in recorded.items()]
+                }]
+            },
+            'Resource': resource
+        }
+        for name, (unit, values) in recorded.items():
+            document[name] = values[:100]
+            del values[:100]
+        recorded = OrderedDict((name, value) for name, value in recorded.items() if len(value[1]) > 0)
+        print(json.dumps(document))
+
+def HandleEvent(event, context):
+    # Copy jobs are run by this function invoking itself asynchronously
+    if 'CopyJob' in event:
+        return RunCopyJob(event['CopyJob'], context)
+    role_arn = None
+    try:
+        if event['resource'] == '/jobs/{JobId}':
+            logger.info('API call for "get job status" received...')
+### Get Copy Job Status ###
+            job = LoadJob(event['pathParameters']['JobId'])
+            if job is None:
+                return {
+                    'statusCode': 404,
+                    'body': json.dumps({
+                        'errorMessage': 'Job not found.'
+                    })
+                }
+            job.pop('RoleArn')
+            # A pending job may be waiting in the asynchronous invocation queue, which holds events for up to JOB_MAX_EVENT_AGE seconds
+            stale_after = JOB_STALE_AFTER if job['State'] == 'RUNNING' else JOB_MAX_EVENT_AGE + JOB_STALE_AFTER
+            if job['State'] in ['PENDING', 'RUNNING'] and time.time() - job['Updated'] > stale_after:
+                job['State'] = 'FAILED'
+                job['Message'] = 'Model upload stopped responding.'
+            return {
+                'statusCode': 200,
+                'body': json.dumps(job)
+            }
+        if event['resource'] == '/uploads':
+            logger.info('API call for "store uploaded model" received...')
+### Store Uploaded Model ###
+            # Models uploaded straight from the browser are staged in the destination bucket and stored by a copy job, so that hashing them
+            # does not hold up the web app
+            request = LoadRequestBody(event) or {}
+            key = request.get('Key')
+            destination_key = request.get('DestinationKey')
+            if not isinstance(key, str) or not isinstance(destination_key, str) or not key.startswith(UPLOAD_PREFIX) or not re.match(r'^[^/]+\.tar\.gz$', destination_key):
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'errorMessage': f'Key must be a staged upload under {UPLOAD_PREFIX} and DestinationKey a model file name.'
+                    })
+                }
+            if S3ObjectExists(GetDestinationResource(), os.environ['DESTINATION_BUCKET'], destination_key):
+                return {
+                    'statusCode': 409,
+                    'body': json.dumps({
+                        'errorMessage': 'A model with the same name already exists.'
+                    })
+                }
+            job = {
+                'JobId': str(uuid.uuid4()),
+                'State': 'PENDING',
+                # No role is assumed since the staged upload is already in the destination bucket
+                'RoleArn': None,
+                'Region': os.environ.get('AWS_REGION'),
+                'Source': f"s3://{os.environ['DESTINATION_BUCKET']}/{key}",
+                'DestinationKey': destination_key,
+                'Staged': True,
+                'BytesCopied': 0,
+                'TotalBytes': None
+            }
+            StartCopyJob(job, context)
+            return {
+                'statusCode': 202,
+                'body': json.dumps({
+                    'message': 'Model upload started.',
+                    'JobId': job['JobId']
+                })
+            }
         # Assume the role provided to get temporary credentials
         logger.info('Getting temporary credentials...')
         role_arn = event['queryStringParameters']['RoleArn']
@@ -23,87 +206,117 @@ def lambda_handler(event, context):
         if event['resource'] == '/models':
             logger.info('API call for "get model list" received...')
 ### List Models ###
-            # Set region to us-east-1 if not supplied, since Deep Racer is only available in us-east-1 at present.
+            # Set region to us-east-1 if not supplied. A comma separated list of regions is accepted, or 'all' for every region that has a Deep Racer bucket.
             source_region = 'us-east-1' if 'Region' not in event['queryStringParameters'] else event['queryStringParameters']['Region']
-            logger.info(f'Sagemaker region set to {source_region}.')
+            source_regions = None if source_region.lower() == 'all' else [r.strip() for r in source_region.split(',') if r.strip() != '']
+            if source_regions == []:
+                source_region = 'us-east-1'
+                source_regions = [source_region]
+            if source_regions is not None:
+                # A region listed twice would return its models twice
+                source_regions = list(OrderedDict.fromkeys(source_regions))
+                if not set(source_regions) <= SAGEMAKER_REGIONS:
+                    return {
+                        'statusCode': 400,
+                        'body': json.dumps({
+                            'errorMessage': f"Unknown region(s): {', '.join(r for r in source_regions if r not in SAGEMAKER_REGIONS)}."
+                        })
+                    }
+            logger.info(f'Sagemaker region(s) set to {source_region}.')
+            # Force a full rebuild of the model catalog snapshot if requested
+            refresh = event['queryStringParameters'].get('refresh', 'false').lower() == 'true'
+            # Optional filtering, sorting and cursor based pagination of the result
+            query = event['queryStringParameters']
+            sort = query.get('Sort', 'ModelName')
+            order = query.get('Order', 'asc')
+            if sort not in ['ModelName', 'TrainingJobName', 'Region'] or order not in ['asc', 'desc']:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'errorMessage': 'Sort must be one of ModelName, TrainingJobName or Region and Order must be asc or desc.'
+                    })
+                }
+            limit = query.get('Limit')
+            if (limit is not None and not (limit.isdecimal() and int(limit) > 0)) or (query.get('Cursor') and DecodeCursor(query['Cursor']) is None):
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'errorMessage': 'Limit must be a positive integer and Cursor must be a cursor returned by a previous request.'
+                    })
+                }
             # Get Deep Racer Models
-            models = GetDeepRacerModels(creds, source_region, src_account)
+            models = GetDeepRacerModels(creds, source_regions, src_account, refresh)
+            total = len(models)
+            RecordMetric('Models', total, 'Count')
+            models, cursor = PageModels(models, query.get('Prefix'), sort, order == 'desc', query.get('Cursor'), int(limit) if limit is not None else None)
             return {
                 'statusCode': 200,
-                'body': json.dumps({'models': models})
+                'body': json.dumps({'models': models, 'cursor': cursor, 'total': total})
             }
         elif event['resource'] == '/models/{Region}/{JobId}':
             logger.info('API call for "upload model" received...')
 ### Upload or Delete Model ###
             source_region = event['pathParameters']['Region']
             logger.info(f'Sagemaker region received as {source_region}.')
-            # Create clients to use
-            sagemaker, src_s3 = GetClients(creds, source_region)
-            # Get training job details
-            logger.info(f"Getting Sagemaker training job: {event['pathParameters']['JobId']}...")
-            model = GetDeepRacerModelInfo(sagemaker, src_s3, {'TrainingJobName': event['pathParameters']['JobId'], 'Region': source_region}, src_account)
-            logger.info(model)
-            # Build destination S3 key
-            destination_key = f"{model['ModelName']}-{src_account}-{model['Region']}.tar.gz"
-            logger.info(f'Destination key determined as {destination_key}.')
-            # Check if destination key already exists
-            dst_s3 = boto3.resource('s3')
-            if S3ObjectExists(dst_s3, os.environ['DESTINATION_BUCKET'], destination_key):
-                logger.info(f'Destination key already exists.')
-                # Check for GET ot DELETE method
-                if event['httpMethod'] == 'GET':
-                    # Upload model request
-                    return {
-                        'statusCode': 200,
-                        'body': json.dumps({
-                            'message': 'Model already present.'
-                        })
-                    }
-                elif event['httpMethod'] == 'DELETE':
-                    # Delete model request
-                    dst_obj = dst_s3.Object(os.environ['DESTINATION_BUCKET'], destination_key)
-                    dst_obj.delete()
-                    return {
-                        'statusCode': 200,
-                        'body': json.dumps({
-                            'message': 'Model deleted.'
-                        })
-                    }
-            else:
-                # Check for GET ot DELETE method
-                if event['httpMethod'] == 'GET':
-                    # Upload model request
-                    # Download output model to local tmp folder
-                    logger.info(f"Downloading file: {model['S3ModelArtifacts']}...")
-                    src_s3.meta.client.download_file(model['S3ModelArtifacts'].split('/', 3)[2], model['S3ModelArtifacts'].split('/', 3)[3], f'/tmp/{destination_key}')
-                    logger.info('Download complete.')
-                    # Upload to new destination folder
-                    logger.info(f"Uploading file: s3://{os.environ['DESTINATION_BUCKET']}/{destination_key}...")
-                    dst_s3.meta.client.upload_file(f'/tmp/{destination_key}', os.environ['DESTINATION_BUCKET'], destination_key)
-                    logger.info('Upload complete.')
-                    # Clean up local tmp
-                    logger.info(f'Deleting local file: /tmp/{destination_key}...')
-                    os.remove(f'/tmp/{destination_key}')
-                    logger.info('Delete complete.')
+            status_code, body = ModelAction(creds, role_arn, src_account, source_region, event['pathParameters']['JobId'], event['httpMethod'], context)
+            return {
+                'statusCode': status_code,
+                'body': json.dumps(body)
+            }
+        elif event['resource'] == '/models/batch':
+            logger.info('API call for "batch upload or delete models" received...')
+### Batch Upload or Delete Models ###
+            request = LoadRequestBody(event) or {}
+            models = request.get('Models')
+            if request.get('Action') not in ['Upload', 'Delete'] or not isinstance(models, list) or len(models) > BATCH_LIMIT:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'errorMessage': f'Action must be Upload or Delete and Models a list of at most {BATCH_LIMIT} models.'
+                    })
+                }
+            # Each model is given as Region/TrainingJobName
+            invalid = [m for m in models if not (isinstance(m, str) and re.match(r'^[a-z0-9-]+/[a-zA-Z0-9](-*[a-zA-Z0-9]){0,62}$', m) and m.split('/')[0] in SAGEMAKER_REGIONS)]
+            if len(invalid) > 0:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'errorMessage': f'Models must be given as Region/TrainingJobName: {json.dumps(invalid)}'
+                    })
+                }
+            method = {'Upload': 'GET', 'Delete': 'DELETE'}[request['Action']]
+            logger.info(f"{request['Action']} of {len(models)} models requested...")
+            # The role has been assumed once above and the clients are shared, so each model only costs its own API calls
+            def BatchItem(model_id):
+                try:
+                    status_code, body = ModelAction(creds, role_arn, src_account, model_id.split('/')[0], model_id.split('/')[1], method, context)
+                    return dict(body, Model=model_id, statusCode=status_code)
+                except ClientError as e:
+                    logger.error(e)
                     return {
-                        'statusCode': 200,
-                        'body': json.dumps({
-                            'message': 'Model uploaded.'
-                        })
+                        'Model': model_id,
+                        'statusCode': e.response['ResponseMetadata']['HTTPStatusCode'],
+                        'errorMessage': re.sub(r'User:\sarn:\S+', f'Role: {role_arn}', str(e))
                     }
-                elif event['httpMethod'] == 'DELETE':
-                    # Delete model request
+                except Exception as e:
+                    # Any other failure is reported against this model only so that the rest of the batch still completes
+                    logger.error(e)
                     return {
-                        'statusCode': 200,
-                        'body': json.dumps({
-                            'message': 'Model was not uploaded so nothing to delete.'
-                        })
+                        'Model': model_id,
+                        'statusCode': 500,
+                        'errorMessage': str(e)
                     }
+            with ThreadPoolExecutor(max_workers=LIST_CONCURRENCY) as executor:
+                results = list(executor.map(BatchItem, models))
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'results': results})
+            }
 
     except ClientError as e:
         logger.error(e)
         # Update error message before returning it to API Gateway so that message is customer facing.
-        if e.operation_name == 'AssumeRole':
+        if e.operation_name == 'AssumeRole' or role_arn is None:
             error_message = re.sub(r'User:\sarn:\S+', 'User', str(e))
         else:
             error_message = re.sub(r'User:\sarn:\S+', f'Role: {role_arn}', str(e))
@@ -114,65 +327,275 @@ def lambda_handler(event, context):
             })
         }
 
+def LoadRequestBody(event):
+    # Parse the JSON object sent as the request body, or return None if there is no body or it is not a JSON object
+    try:
+        request = json.loads(event.get('body') or '')
+    except ValueError:
+        return None
+    return request if isinstance(request, dict) else None
+
+@xray_recorder.capture('ModelAction')
+def ModelAction(creds, role_arn, src_account, source_region, job_name, method, context):
+    # Upload (GET) or delete (DELETE) a single model and return the status code and response body
+    # Create clients to use
+    sagemaker, src_s3 = GetClients(creds, source_region)
+    # Get training job details
+    logger.info(f"Getting Sagemaker training job: {job_name}...")
+    model = GetDeepRacerModelInfo(sagemaker, src_s3, {'TrainingJobName': job_name, 'Region': source_region}, src_account)
+    logger.info(model)
+    # Build destination S3 key
+    destination_key = f"{model['ModelName']}-{src_account}-{model['Region']}.tar.gz"
+    logger.info(f'Destination key determined as {destination_key}.')
+    # Check if destination key already exists
+    dst_s3 = GetDestinationResource()
+    if S3ObjectExists(dst_s3, os.environ['DESTINATION_BUCKET'], destination_key):
+        logger.info(f'Destination key already exists.')
+        # Check for GET ot DELETE method
+        if method == 'GET':
+            # Upload model request
+            return 200, {
+                'message': 'Model already present.'
+            }
+        elif method == 'DELETE':
+            # Delete model request
+            DeleteModel(dst_s3, os.environ['DESTINATION_BUCKET'], destination_key)
+            return 200, {
+                'message': 'Model deleted.'
+            }
+    else:
+        # Check for GET ot DELETE method
+        if method == 'GET':
+            # Upload model request
+            # Start an asynchronous copy job so that large models are not limited by the API Gateway timeout
+            job = {
+                'JobId': str(uuid.uuid4()),
+                'State': 'PENDING',
+                'RoleArn': role_arn,
+                'Region': model['Region'],
+                'Source': model['S3ModelArtifacts'],
+                'DestinationKey': destination_key,
+                'BytesCopied': 0,
+                'TotalBytes': None
+            }
+            StartCopyJob(job, context)
+            return 202, {
+                'message': 'Model upload started.',
+                'JobId': job['JobId']
+            }
+        elif method == 'DELETE':
+            # Delete model request
+            return 200, {
+                'message': 'Model was not uploaded so nothing to delete.'
+            }
+
 @xray_recorder.capture('AssumeRole')
 def AssumeRole(role_arn, session_name):
+    # Return cached credentials for the role if they are not close to expiring
+    creds = CacheGet(credential_cache, role_arn)
+    if creds is not None and creds['Expiration'] - datetime.now(timezone.utc) > CREDENTIAL_EXPIRY_MARGIN:
+        logger.info(f'Using cached credentials for role: {role_arn}')
+        return creds
     sts = boto3.client('sts')
     logger.info(f'Attempting to assume role: {role_arn}...')
-    assume_role = sts.assume_role(
-        RoleArn = role_arn,
-        RoleSessionName = session_name
-    )
+    with Timer('AssumeRole'):
+        assume_role = sts.assume_role(
+            RoleArn = role_arn,
+            RoleSessionName = session_name
+        )
     logger.info('Role assumed')
+    CachePut(credential_cache, role_arn, assume_role['Credentials'])
     return assume_role['Credentials']
 
 @xray_recorder.capture('GetDeepRacerModels')
-def GetDeepRacerModels(creds, region, src_account):
-    # Create clients to use
-    sagemaker, src_s3 = GetClients(creds, region)
-    models = {}
+def GetDeepRacerModels(creds, regions, src_account, refresh=False):
+    # S3 is global so any region will do for listing the buckets
+    _, src_s3 = GetClients(creds, regions[0] if regions else 'us-east-1')
+    # Find the S3 buckets used by DeepRacer and the region each one lives in
+    buckets = GetDeepRacerBuckets(src_s3, regions)
+    if regions is None:
+        regions = sorted(set(buckets.values())) or ['us-east-1']
+    logger.info(f'Discovering models in region(s): {regions}...')
+    # Build the index of models already uploaded for this account and these regions once, rather than a HEAD request per model
+    uploaded = GetDestinationIndex(os.environ['DESTINATION_BUCKET'], tuple(f'-{src_account}-{r}.tar.gz' for r in regions))
+    # Discover each region concurrently, only searching the buckets that live in that region
+    with ThreadPoolExecutor(max_workers=min(len(regions), LIST_CONCURRENCY)) as executor:
+        results = executor.map(
+            lambda region: GetRegionModels(creds, region, [b for b, r in buckets.items() if r == region], src_account, uploaded, refresh),
+            regions
+        )
+        models = [m for region_models in results for m in region_models]
+    # Return the merged list sorted by model name and then region
+    return sorted(models, key=lambda k: (k['ModelName'], k['Region']))
+
+@xray_recorder.capture('GetDeepRacerBuckets')
+@Timer('ListBuckets')
+def GetDeepRacerBuckets(src_s3, regions):
+    # Return a dict of Deep Racer bucket name to bucket region, filtered to the requested regions (None for all regions)
+    buckets = {}
     for bucket in src_s3.buckets.all():
-        # Find the S3 bucket used by DeepRacer
         if bucket.name.startswith('aws-deepracer-'):
-            for o in bucket.objects.filter(Prefix='DeepRacer-SageMaker-rlmdl-'):
+            try:
+                location = src_s3.meta.client.get_bucket_location(Bucket=bucket.name)['LocationConstraint']
+                # Buckets in us-east-1 have no location constraint and eu-west-1 buckets may report the legacy 'EU' value
+                location = {None: 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'AccessDenied':
+                    logger.error(e)
+                    raise e
+                # Roles created before s3:GetBucketLocation was required still work, the bucket is searched from the first requested region as before
+                location = regions[0] if regions else 'us-east-1'
+                logger.info(f'Unable to get location of bucket {bucket.name}. Assuming {location}.')
+            if regions is None or location in regions:
+                buckets[bucket.name] = location
+    logger.info(f'Deep Racer buckets found: {buckets}')
+    return buckets
+
+@xray_recorder.capture('GetRegionModels')
+def GetRegionModels(creds, region, buckets, src_account, uploaded, refresh=False):
+    # Create clients to use
+    sagemaker, src_s3 = GetClients(creds, region)
+    # Collect the model artifacts first so that only new training jobs need describing, and those concurrently
+    artifacts = []
+    with Timer('ListArtifacts'):
+        for bucket in buckets:
+            for o in src_s3.Bucket(bucket).objects.filter(Prefix='DeepRacer-SageMaker-rlmdl-'):
                 # Just keys for model files only
                 if o.key.endswith('model.tar.gz'):
-                    model = GetDeepRacerModelInfo(sagemaker, src_s3, {'S3ModelArtifacts': o.key, 'TrainingJobName': o.key.split('/')[1], 'Region': region}, src_account)
-                    model_name = model.pop('ModelName')
-                    if model_name in models:
-                        # Duplicate found. Replace the existing info if the model is newer (training job name contains dt in YYYYMMDDHHMMSS format)
-                        if models[model_name]['Region'] == model['Region'] and models[model_name]['TrainingJobName'] > model['TrainingJobName']:
-                            models[model_name] = model
-                    # No duplicate so just add it to the dict
-                    else:
-                        models[model_name] = model
+                    artifacts.append({'Path': f'{bucket}/{o.key}', 'Key': o.key, 'ETag': o.e_tag})
+    # Load the catalog snapshot from the last listing unless a full rebuild was requested
+    catalog = {} if refresh else LoadCatalog(src_account, region)
+    pending = [a for a in artifacts if a['Path'] not in catalog or catalog[a['Path']]['ETag'] != a['ETag']]
+    RecordMetric('CatalogMisses', len(pending), 'Count')
+    logger.info(f'Found {len(artifacts)} model artifacts in {region}, {len(pending)} not in the catalog. Describing training jobs with {LIST_CONCURRENCY} workers...')
+    with ThreadPoolExecutor(max_workers=LIST_CONCURRENCY) as executor:
+        described = executor.map(
+            lambda a: GetDeepRacerModelInfo(sagemaker, src_s3, {'S3ModelArtifacts': a['Key'], 'TrainingJobName': a['Key'].split('/')[1], 'Region': region}, src_account, uploaded),
+            pending
+        )
+        for a, model in zip(pending, described):
+            catalog[a['Path']] = {'ModelName': model['ModelName'], 'TrainingJobName': model['TrainingJobName'], 'Region': model['Region'], 'ETag': a['ETag']}
+    # Drop artifacts that no longer exist and save the snapshot if anything changed
+    new_catalog = {a['Path']: catalog[a['Path']] for a in artifacts}
+    if refresh or len(pending) > 0 or len(new_catalog) != len(catalog):
+        SaveCatalog(src_account, region, new_catalog)
+    # Walk the artifacts in listing order so the de-duplication below behaves as if run serially
+    models = {}
+    for a in artifacts:
+        entry = new_catalog[a['Path']]
+        model = {'TrainingJobName': entry['TrainingJobName'], 'Region': entry['Region'], 'Uploaded': f"{entry['ModelName']}-{src_account}-{entry['Region']}.tar.gz" in uploaded}
+        model_name = entry['ModelName']
+        if model_name in models:
+            # Duplicate found. Replace the existing info if the model is newer (training job name contains dt in YYYYMMDDHHMMSS format)
+            if models[model_name]['Region'] == model['Region'] and models[model_name]['TrainingJobName'] > model['TrainingJobName']:
+                models[model_name] = model
+        # No duplicate so just add it to the dict
+        else:
+            models[model_name] = model
     # Convert the dict to an list so that we can sort it
     models = [v.update({'ModelName': k}) or v for k,v in models.items()]
     # Return the sorted list
     return sorted(models, key=lambda k: k['ModelName'])
 
+def PageModels(models, prefix=None, sort='ModelName', descending=False, cursor=None, limit=None):
+    # Filter by model name prefix, sort and return the page after the cursor along with the cursor for the next page
+    if prefix:
+        models = [m for m in models if m['ModelName'].lower().startswith(prefix.lower())]
+    # Model name and region make the sort key unique so the cursor is stable when models are added or removed between pages
+    sort_key = lambda m: [m[sort], m['ModelName'], m['Region']]
+    models = sorted(models, key=sort_key, reverse=descending)
+    if cursor:
+        after = DecodeCursor(cursor)
+        models = [m for m in models if (sort_key(m) < after if descending else sort_key(m) > after)]
+    if limit is None or len(models) <= limit:
+        return models, None
+    page = models[:limit]
+    return page, base64.urlsafe_b64encode(json.dumps(sort_key(page[-1])).encode('utf-8')).decode('utf-8')
+
+def DecodeCursor(cursor):
+    # Decode a cursor returned by PageModels, or return None if it is malformed
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+    except ValueError:
+        return None
+    if not isinstance(after, list) or len(after) != 3 or not all(isinstance(v, str) for v in after):
+        return None
+    return after
+
+@xray_recorder.capture('LoadCatalog')
+def LoadCatalog(src_account, region):
+    # Read the catalog snapshot for the account and region from the destination bucket. A missing snapshot is an empty catalog.
+    key = f"{os.environ.get('CATALOG_PREFIX', 'catalog/')}{src_account}-{region}.json"
+    try:
+        body = GetDestinationResource().Object(os.environ['DESTINATION_BUCKET'], key).get()['Body'].read()
+        return json.loads(body)['Models']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            logger.info(f'No catalog snapshot found at {key}.')
+            return {}
+        logger.error(e)
+        raise e
+
+@xray_recorder.capture('SaveCatalog')
+def SaveCatalog(src_account, region, catalog):
+    # Write the catalog snapshot for the account and region to the destination bucket
+    key = f"{os.environ.get('CATALOG_PREFIX', 'catalog/')}{src_account}-{region}.json"
+    logger.info(f'Saving catalog snapshot of {len(catalog)} artifacts to {key}...')
+    GetDestinationResource().Object(os.environ['DESTINATION_BUCKET'], key).put(
+        Body = json.dumps({'Models': catalog}),
+        ContentType = 'application/json'
+    )
+
 @xray_recorder.capture('GetClients')
 def GetClients(creds, region):
+    # Credentials are cached per role so the access key identifies the role. A refreshed set of credentials therefore gets new clients.
+    cache_key = (creds['AccessKeyId'], region)
+    clients = CacheGet(client_cache, cache_key)
+    if clients is not None:
+        logger.info(f'Using cached clients for region: {region}')
+        return clients
+    # Use a new session since clients may be created from several threads at once and the default session is not thread safe
+    session = boto3.session.Session()
     # Create Sagemaker client to be able to get Deep Racer training jobs
-    sagemaker = boto3.client(
+    sagemaker = session.client(
         'sagemaker',
         aws_access_key_id = creds['AccessKeyId'],
         aws_secret_access_key = creds['SecretAccessKey'],
         aws_session_token = creds['SessionToken'],
-        region_name = region
+        region_name = region,
+        config = SAGEMAKER_CONFIG
     )
     # Create S3 client to be able to check if the model output still exists (we only return model names for models where the output exists)
-    s3 = boto3.resource(
+    s3 = session.resource(
         's3',
         aws_access_key_id = creds['AccessKeyId'],
         aws_secret_access_key = creds['SecretAccessKey'],
         aws_session_token = creds['SessionToken']
     )
+    CachePut(client_cache, cache_key, (sagemaker, s3))
     return sagemaker, s3
 
+def CacheGet(cache, key):
+    # Look up a cache entry and mark it as most recently used
+    with cache_lock:
+        if key not in cache:
+            return None
+        cache.move_to_end(key)
+        return cache[key]
+
+def CachePut(cache, key, value):
+    # Add a cache entry, dropping the least recently used entry once the cache is full
+    with cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+
 @xray_recorder.capture('GetDeepRacerModelInfo')
-def GetDeepRacerModelInfo(sagemaker, src_s3, model, src_account):
+def GetDeepRacerModelInfo(sagemaker, src_s3, model, src_account, uploaded=None):
     # Get training job details
-    training_job = sagemaker.describe_training_job(TrainingJobName = model['TrainingJobName'])
+    with Timer('DescribeTrainingJob'):
+        training_job = sagemaker.describe_training_job(TrainingJobName = model['TrainingJobName'])
     # Split the s3 path for the reward function path hyper parameter to extract the model name
     model['ModelName'] = training_job['HyperParameters']['reward_function_s3_source'].split('/')[4]
     # Check if 'S3ModelArtifacts' is already supplied (due to list call as the originator)
@@ -183,20 +606,223 @@ def GetDeepRacerModelInfo(sagemaker, src_s3, model, src_account):
         if S3ObjectExists(src_s3, training_job['ModelArtifacts']['S3ModelArtifacts']):
             model['S3ModelArtifacts'] = training_job['ModelArtifacts']['S3ModelArtifacts']
     # Set the uploaded property based upon whether a model with the same name already exists in our S3 bucket therefore indicating the model has already been uploaded.
-    model['Uploaded'] = S3ObjectExists(boto3.resource('s3'), os.environ['DESTINATION_BUCKET'], f"{model['ModelName']}-{src_account}-{model['Region']}.tar.gz")
+    destination_key = f"{model['ModelName']}-{src_account}-{model['Region']}.tar.gz"
+    if uploaded is None:
+        model['Uploaded'] = S3ObjectExists(GetDestinationResource(), os.environ['DESTINATION_BUCKET'], destination_key)
+    else:
+        # Answer from the pre-built destination index (list call as the originator)
+        model['Uploaded'] = destination_key in uploaded
     return model
 
+@xray_recorder.capture('CopyModel')
+def CopyModel(src_s3, dst_s3, source_path, bucket, key, callback=None, server_side=False):
+    source = {'Bucket': source_path.split('/', 3)[2], 'Key': source_path.split('/', 3)[3]}
+    # The model bucket has no policy allowing other accounts to write to it, so a server side copy is only tried when the source role is in
+    # the same account as this function. Large objects are then copied with parallel upload_part_copy calls so no data passes through the Lambda.
+    if server_side:
+        try:
+            src_s3.meta.client.copy(source, bucket, key, ExtraArgs={'ACL': 'bucket-owner-full-control'}, Callback=callback, Config=COPY_CONFIG)
+            logger.info('Server side copy complete.')
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['AccessDenied', '403']:
+                logger.error(e)
+                raise e
+            logger.info('Server side copy not permitted. Streaming the object instead...')
+    # Stream the source body straight into a multipart upload without touching local disk
+    body = src_s3.meta.client.get_object(**source)['Body']
+    dst_s3.meta.client.upload_fileobj(body, bucket, key, Callback=callback, Config=STREAM_CONFIG)
+    logger.info('Streamed copy complete.')
+
+def StartCopyJob(job, context):
+    # Save the job's status record and run the job asynchronously by invoking this function
+    SaveJob(job)
+    logger.info(f"Starting copy job {job['JobId']}: {job['Source']} to s3://{os.environ['DESTINATION_BUCKET']}/{job['DestinationKey']}...")
+    GetLambdaClient().invoke(
+        FunctionName = context.invoked_function_arn,
+        InvocationType = 'Event',
+        Payload = json.dumps({'CopyJob': job})
+    )
+
+@xray_recorder.capture('RunCopyJob')
+def RunCopyJob(job, context):
+    job['State'] = 'RUNNING'
+    SaveJob(job)
+    progress_lock = threading.Lock()
+    last_saved = [time.time()]
+    def progress(bytes_transferred):
+        # Called by the transfer manager from its worker threads, so only write the status record every few seconds
+        with progress_lock:
+            job['BytesCopied'] += bytes_transferred
+            if time.time() - last_saved[0] >= JOB_PROGRESS_INTERVAL:
+                last_saved[0] = time.time()
+                SaveJob(job)
+    try:
+        if job['RoleArn'] is None:
+            src_s3 = GetDestinationResource()
+        else:
+            creds = AssumeRole(job['RoleArn'], context.function_name)
+            _, src_s3 = GetClients(creds, job['Region'])
+        head = src_s3.meta.client.head_object(Bucket=job['Source'].split('/', 3)[2], Key=job['Source'].split('/', 3)[3])
+        job['TotalBytes'] = head['ContentLength']
+        SaveJob(job)
+        # A staged upload under the same name may have been stored while this job was waiting to run
+        if job.get('Staged') and S3ObjectExists(GetDestinationResource(), os.environ['DESTINATION_BUCKET'], job['DestinationKey']):
+            raise Exception('A model with the same name already exists.')
+        # Identical models are only stored once, so there is nothing to copy if the content is already in the bucket
+        blob_key = f"{BLOB_PREFIX}{GetContentDigest(src_s3, job['Source'], head, progress)}.tar.gz"
+        if ClaimBlob(GetDestinationResource(), os.environ['DESTINATION_BUCKET'], blob_key):
+            logger.info(f'Identical model already stored as {blob_key}.')
+            RecordMetric('DuplicateModels', 1, 'Count')
+        else:
+            copy_start = time.time()
+            same_account = job['RoleArn'] is None or job['RoleArn'].split(':')[4] == context.invoked_function_arn.split(':')[4]
+            CopyModel(src_s3, GetDestinationResource(), job['Source'], os.environ['DESTINATION_BUCKET'], blob_key, progress, same_account)
+            copy_seconds = time.time() - copy_start
+            RecordMetric('CopyDuration', copy_seconds * 1000)
+            RecordMetric('CopyThroughput', job['TotalBytes'] / 1024 / 1024 / max(copy_seconds, 0.001), 'Megabytes/Second')
+        PutModelAlias(GetDestinationResource(), os.environ['DESTINATION_BUCKET'], job['DestinationKey'], blob_key)
+        # Claim the blob again in case a delete marked it unreferenced before the alias was written
+        ClaimBlob(GetDestinationResource(), os.environ['DESTINATION_BUCKET'], blob_key)
+        if job.get('Staged'):
+            src_s3.meta.client.delete_object(Bucket=job['Source'].split('/', 3)[2], Key=job['Source'].split('/', 3)[3])
+        with progress_lock:
+            job['State'] = 'SUCCEEDED'
+            job['BytesCopied'] = job['TotalBytes']
+            job['Message'] = 'Model uploaded.'
+            SaveJob(job)
+        logger.info(f"Copy job {job['JobId']} complete.")
+    except Exception as e:
+        # Record the failure rather than raising, since an asynchronous invocation that raises is retried and would copy again
+        logger.error(e)
+        with progress_lock:
+            job['State'] = 'FAILED'
+            # Update error message so that message is customer facing.
+            job['Message'] = re.sub(r'User:\sarn:\S+', f"Role: {job['RoleArn']}", str(e))
+            SaveJob(job)
+    return job
+
+@xray_recorder.capture('GetContentDigest')
+def GetContentDigest(src_s3, source_path, head, callback=None):
+    # The ETag of an object uploaded in a single part without KMS encryption is already the MD5 of its content.
+    # Otherwise the MD5 is calculated by reading the object, which costs less than storing and syncing a duplicate model.
+    etag = head['ETag'].strip('"')
+    if '-' not in etag and head.get('ServerSideEncryption') != 'aws:kms':
+        return etag
+    logger.info(f'ETag of {source_path} is not an MD5 of the content. Calculating it...')
+    md5 = hashlib.md5()
+    body = src_s3.meta.client.get_object(Bucket=source_path.split('/', 3)[2], Key=source_path.split('/', 3)[3], IfMatch=head['ETag'])['Body']
+    for chunk in body.iter_chunks(1024 * 1024):
+        md5.update(chunk)
+        # Nothing is copied yet but the callback keeps the job's status record fresh so that it is not reported as stalled
+        if callback is not None:
+            callback(0)
+    return md5.hexdigest()
+
+def PutModelAlias(dst_s3, bucket, key, blob_key):
+    # The alias body is the blob key so that every alias of a blob has the same ETag, which lets a listing find them
+    dst_s3.Object(bucket, key).put(
+        Body = blob_key.encode('utf-8'),
+        Metadata = {'blob': blob_key},
+        ContentType = 'text/plain'
+    )
+
+@xray_recorder.capture('ClaimBlob')
+def ClaimBlob(dst_s3, bucket, blob_key):
+    # Clear any unreferenced mark from a blob that is about to be used and return whether the blob exists
+    if not S3ObjectExists(dst_s3, bucket, blob_key):
+        return False
+    try:
+        dst_s3.meta.client.delete_object_tagging(Bucket=bucket, Key=blob_key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            return False
+        logger.error(e)
+        raise e
+
+def BlobReferenced(dst_s3, bucket, blob_key):
+    alias_etag = f'"{hashlib.md5(blob_key.encode("utf-8")).hexdigest()}"'
+    # Aliases are all at the top level of the bucket so the other prefixes do not need listing
+    paginator = dst_s3.meta.client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Delimiter='/'):
+        if any(o['ETag'] == alias_etag for o in page.get('Contents', [])):
+            return True
+    return False
+
+@xray_recorder.capture('DeleteModel')
+def DeleteModel(dst_s3, bucket, key):
+    # Delete a model alias. Models uploaded before aliases existed are deleted as before.
+    dst_obj = dst_s3.Object(bucket, key)
+    blob_key = dst_obj.metadata.get('blob')
+    dst_obj.delete()
+    if blob_key is None or BlobReferenced(dst_s3, bucket, blob_key):
+        return
+    # The blob is not deleted here since an upload may be about to reuse it. It is marked unreferenced and a lifecycle rule expires it,
+    # and any upload that reuses it clears the mark after writing its alias. Checking again after marking closes the gap between the two.
+    logger.info(f'Marking {blob_key} as unreferenced.')
+    dst_s3.meta.client.put_object_tagging(Bucket=bucket, Key=blob_key, Tagging={'TagSet': [{'Key': 'unreferenced', 'Value': 'true'}]})
+    if BlobReferenced(dst_s3, bucket, blob_key):
+        logger.info(f'{blob_key} was reused while being marked.')
+        ClaimBlob(dst_s3, bucket, blob_key)
+
+@xray_recorder.capture('LoadJob')
+def LoadJob(job_id):
+    # Read the status record of a copy job from the destination bucket. A missing record means the job does not exist.
+    key = f"{os.environ.get('JOB_PREFIX', 'jobs/')}{job_id}.json"
+    try:
+        return json.loads(GetDestinationResource().Object(os.environ['DESTINATION_BUCKET'], key).get()['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            return None
+        logger.error(e)
+        raise e
+
+def SaveJob(job):
+    # Write the status record of a copy job to the destination bucket
+    key = f"{os.environ.get('JOB_PREFIX', 'jobs/')}{job['JobId']}.json"
+    GetDestinationResource().Object(os.environ['DESTINATION_BUCKET'], key).put(
+        Body = json.dumps(dict(job, Updated=time.time())),
+        ContentType = 'application/json'
+    )
+
+@xray_recorder.capture('GetDestinationIndex')
+@Timer('DestinationIndex')
+def GetDestinationIndex(bucket, suffix):
+    # List the destination bucket once and return the set of keys ending with the supplied suffix (or any of a tuple of suffixes)
+    paginator = GetDestinationResource().meta.client.get_paginator('list_objects_v2')
+    keys = set()
+    for page in paginator.paginate(Bucket=bucket):
+        for o in page.get('Contents', []):
+            if o['Key'].endswith(suffix):
+                keys.add(o['Key'])
+    logger.info(f's3://{bucket} contains {len(keys)} keys ending with {suffix}.')
+    return keys
+
+def GetDestinationResource():
+    # Create the destination S3 resource once per thread and reuse it
+    if not hasattr(thread_local, 'dst_s3'):
+        thread_local.dst_s3 = boto3.session.Session().resource('s3')
+    return thread_local.dst_s3
+
+def GetLambdaClient():
+    # Create the Lambda client once per thread and reuse it
+    if not hasattr(thread_local, 'lambda_client'):
+        thread_local.lambda_client = boto3.session.Session().client('lambda')
+    return thread_local.lambda_client
+
 @xray_recorder.capture('S3ObjectExists')
+@Timer('HeadObject')
 def S3ObjectExists(client, pathORbucket, key=None):
-    # Use S3 metadata property to detect is S3 object already exists or not
+    # Use a HEAD request to detect if the S3 object already exists or not. The resource's low level client is used since it is thread
+    # safe, whereas the resource itself may be shared by the batch threads through the client cache.
     if key is None:
         key = pathORbucket.split('/', 3)[3]
         bucket = pathORbucket.split('/', 3)[2]
     else:
         bucket = pathORbucket
-    obj = client.Object(bucket, key)
     try:
-        obj.metadata
+        client.meta.client.head_object(Bucket=bucket, Key=key)
         logger.info(f's3://{bucket}/{key} exists.')
         return True
     except ClientError as e:
@@ -3,41 +3,545 @@ import sys
 import boto3
 import json
 import os
+import glob
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote_plus, urlparse
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
-def long_poll_queue():
-    while(True):
-        sqs = boto3.resource('sqs')
-        queue = sqs.Queue(os.environ['QUEUE_URL'])
-        receive_messages = queue.receive_messages(
-            AttributeNames = ['All'],
-            WaitTimeSeconds = 20
-        )
-        if len(receive_messages) == 0:
-            logger.info('No messages found. Checking again...')
+# Number of objects downloaded at the same time
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', '4'))
+# Size of each ranged GET and the number of ranges of a single object downloaded at the same time
+PART_SIZE = int(os.environ.get('PART_SIZE_MB', '8')) * 1024 * 1024
+PART_CONCURRENCY = int(os.environ.get('PART_CONCURRENCY', '4'))
+# Seconds between reconciliation scans of the bucket against the local folder
+RECONCILE_INTERVAL = int(os.environ.get('RECONCILE_INTERVAL', '3600'))
+# Port the manifest change feed is served on for the cars
+MANIFEST_PORT = int(os.environ.get('MANIFEST_PORT', '8080'))
+# Identical models are stored once in the bucket under this prefix, and the model name keys are small aliases pointing at them
+BLOB_PREFIX = os.environ.get('BLOB_PREFIX', 'blobs/')
+# Folder inside the local folder holding one copy of each blob. The model files are hard links to these.
+BLOB_FOLDER = '.blobs'
+# Aliases of the same blob may be processed at the same time so each blob is downloaded or removed under its own lock
+blob_locks = {}
+blob_locks_lock = threading.Lock()
+# Object in the bucket holding the ordered "up next" list as JSON. Each entry is a model key or the AWS account id of a racer.
+UP_NEXT_KEY = os.environ.get('UP_NEXT_KEY', 'up-next.json')
+# Seconds between checks of the up next list for changes
+UP_NEXT_INTERVAL = int(os.environ.get('UP_NEXT_INTERVAL', '30'))
+# Disk space the local folder may use before least recently used models are evicted (0 for no limit)
+DISK_BUDGET = int(os.environ.get('DISK_BUDGET_MB', '0')) * 1024 * 1024
+
+class Manifest:
+    # Append-only JSON lines log of the objects held in the local folder. Every change gets a sequence number so that cars can ask for
+    # just the changes since the last sequence number they saw instead of scanning the folder.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.sequence = 0
+        # Changes before this sequence number have been compacted away, so clients older than this need the full manifest
+        self.compacted = 0
+        # Keys removed to stay within the disk budget rather than deleted from the bucket, and when each key was last used
+        self.evicted = set()
+        self.used = {}
+        self.log = []
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip() != '':
+                        self.apply(json.loads(line))
+
+    def apply(self, change):
+        # Replay a change from the log into the in-memory view
+        if change['Op'] == 'compact':
+            self.compacted = change['Seq']
+        elif change['Op'] == 'put':
+            self.entries[change['Key']] = dict({k: change[k] for k in ['Seq', 'Size', 'ETag', 'Mtime', 'Sha256']}, Blob=change.get('Blob'))
+            self.evicted.discard(change['Key'])
+            self.used[change['Key']] = change['Mtime']
+        elif change['Op'] == 'delete':
+            self.entries.pop(change['Key'], None)
+            self.used.pop(change['Key'], None)
+            if change.get('Evicted'):
+                self.evicted.add(change['Key'])
+            else:
+                self.evicted.discard(change['Key'])
+        self.sequence = max(self.sequence, change['Seq'])
+        self.log.append(change)
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+    def items(self):
+        with self.lock:
+            return [(k, dict(v, Used=self.used[k])) for k, v in self.entries.items()]
+
+    def is_evicted(self, key):
+        with self.lock:
+            return key in self.evicted
+
+    def touch(self, keys):
+        # Mark models as used now so they are the last to be evicted
+        with self.lock:
+            for key in keys:
+                if key in self.used:
+                    self.used[key] = time.time()
+
+    def blob_in_use(self, blob):
+        with self.lock:
+            return any(entry['Blob'] == blob for entry in self.entries.values())
+
+    def put(self, key, size, etag, sha256=None, blob=None):
+        with self.lock:
+            self.append({'Op': 'put', 'Key': key, 'Size': size, 'ETag': etag, 'Mtime': time.time(), 'Sha256': sha256, 'Blob': blob})
+
+    def remove(self, key, evicted=False):
+        with self.lock:
+            if key in self.entries:
+                self.append({'Op': 'delete', 'Key': key, 'Evicted': evicted})
+
+    def changes(self, since):
+        # Return the changes after the supplied sequence number, or the full manifest if those changes have been compacted away.
+        # A client ahead of the manifest saw a manifest that has since been lost or rebuilt, so it also gets the full manifest.
+        with self.lock:
+            if since < self.compacted or since > self.sequence:
+                return {
+                    'Sequence': self.sequence,
+                    'Reset': True,
+                    'Changes': [dict({'Op': 'put', 'Key': k}, **v) for k, v in sorted(self.entries.items(), key=lambda i: i[1]['Seq'])]
+                }
+            return {
+                'Sequence': self.sequence,
+                'Reset': False,
+                'Changes': [c for c in self.log if c['Seq'] > since and c['Op'] != 'compact']
+            }
+
+    def append(self, change):
+        self.sequence += 1
+        change['Seq'] = self.sequence
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(change) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.apply(change)
+        # Compact the log once it is mostly superseded changes
+        if len(self.log) > 2 * len(self.entries) + 1000:
+            self.compact()
+
+    def compact(self):
+        # Rewrite the log with just the current entries, writing to a temporary file and renaming so a crash never loses the manifest
+        self.compacted = self.sequence
+        log = [{'Op': 'compact', 'Seq': self.sequence}] + [dict({'Op': 'put', 'Key': k}, **v) for k, v in sorted(self.entries.items(), key=lambda i: i[1]['Seq'])]
+        # Evicted keys are remembered so that reconciliation does not download them again
+        log += [{'Op': 'delete', 'Key': k, 'Evicted': True, 'Seq': self.sequence} for k in sorted(self.evicted)]
+        with open(f'{self.path}.tmp', 'w') as f:
+            for change in log:
+                f.write(json.dumps(change) + '\n')
+        os.replace(f'{self.path}.tmp', self.path)
+        self.log = log
+
+class UpNext:
+    # The ordered list of racers expected on track next, read from the bucket. Their models are downloaded first and never evicted.
+    def __init__(self):
+        self.entries = []
+        self.etag = None
+
+    def refresh(self, s3, bucket):
+        # Re-read the list if it has changed and return True if it did
+        try:
+            args = {'IfNoneMatch': self.etag} if self.etag else {}
+            response = s3.get_object(Bucket=bucket, Key=UP_NEXT_KEY, **args)
+        except ClientError as e:
+            if e.response['Error']['Code'] == '304':
+                return False
+            if e.response['Error']['Code'] not in ['NoSuchKey', '404']:
+                raise e
+            changed = len(self.entries) > 0
+            self.entries = []
+            self.etag = None
+            return changed
+        self.entries = [str(entry) for entry in json.loads(response['Body'].read())]
+        self.etag = response['ETag']
+        logger.info(f'Up next list changed: {self.entries}')
+        return True
+
+    def rank(self, key):
+        # Position in the list of the first entry matching the key, or None. Keys end with -{account}.tar.gz or -{account}-{region}.tar.gz.
+        for position, entry in enumerate(self.entries):
+            if key == entry or key.endswith(f'-{entry}.tar.gz') or f'-{entry}-' in key:
+                return position
+        return None
+
+    def order(self, keys):
+        # The keys matching the list, in the order they are needed
+        ranked = [(self.rank(key), key) for key in keys]
+        return [key for rank, key in sorted(r for r in ranked if r[0] is not None)]
+
+class ManifestHandler(BaseHTTPRequestHandler):
+    # Serves the manifest to the cars. GET /changes?since=N returns the changes after sequence number N, along with the keys of the models
+    # that are up next so the cars can pull those first.
+    manifest = None
+    up_next = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/changes':
+            try:
+                since = int(parse_qs(url.query).get('since', ['0'])[0])
+            except ValueError:
+                self.send_error(400, 'since must be an integer')
+                return
+            body = json.dumps(dict(self.manifest.changes(since), UpNext=self.up_next.order(self.manifest.keys()))).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
         else:
-            for message in receive_messages:
-                body = json.loads(message.body)
-                logger.info(f"Message found: {json.dumps(body)}")
-                if 'Records' in body:
-                    for record in body['Records']:
-                        if 's3' in record:
-                            s3 = boto3.resource('s3')
-                            bucket = record['s3']['bucket']['name']
-                            key = record['s3']['object']['key']
-                            local_path = f"{os.environ['LOCAL_FOLDER']}/{key}"
-                            if record['eventName'].startswith('ObjectCreated'):
-                                logger.info(f'Downloading file to: {local_path}')
-                                folder = os.path.dirname(local_path)
-                                if not os.path.exists(folder):
-                                    os.makedirs(folder)
-                                s3.Object(bucket, key).download_file(local_path)
-                            elif record['eventName'].startswith('ObjectRemoved'):
-                                logger.info(f'Deleting file from: {local_path}')
-                                os.remove(local_path) 
-                message.delete()
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+def serve_manifest(manifest, up_next, port):
+    # Run the manifest HTTP endpoint in the background so it does not hold up the queue polling
+    ManifestHandler.manifest = manifest
+    ManifestHandler.up_next = up_next
+    server = ThreadingHTTPServer(('', port), ManifestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Serving manifest changes on port {port}')
+    return server
+
+def long_poll_queue():
+    # Create the resources once and reuse them for every poll
+    sqs = boto3.resource('sqs')
+    queue = sqs.Queue(os.environ['QUEUE_URL'])
+    s3 = boto3.client('s3')
+    if not os.path.exists(os.environ['LOCAL_FOLDER']):
+        os.makedirs(os.environ['LOCAL_FOLDER'])
+    manifest = Manifest(os.environ.get('MANIFEST_PATH', f"{os.environ['LOCAL_FOLDER']}/.manifest.jsonl"))
+    up_next = UpNext()
+    serve_manifest(manifest, up_next, MANIFEST_PORT)
+    last_reconcile = 0
+    last_up_next = 0
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY) as executor:
+        while(True):
+            # Download the models of the racers who are up next before anything else
+            if 'BUCKET_NAME' in os.environ and time.time() - last_up_next > UP_NEXT_INTERVAL:
+                try:
+                    if up_next.refresh(s3, os.environ['BUCKET_NAME']):
+                        prefetch(s3, os.environ['BUCKET_NAME'], manifest, executor, up_next)
+                    last_up_next = time.time()
+                except Exception as e:
+                    logger.error(f'Prefetch failed: {e}')
+            # Reconcile at startup and periodically to recover from messages that were missed or expired
+            if 'BUCKET_NAME' in os.environ and time.time() - last_reconcile > RECONCILE_INTERVAL:
+                try:
+                    reconcile(s3, os.environ['BUCKET_NAME'], manifest, executor, up_next)
+                    last_reconcile = time.time()
+                except Exception as e:
+                    logger.error(f'Reconciliation failed: {e}')
+            receive_messages = queue.receive_messages(
+                AttributeNames = ['All'],
+                MaxNumberOfMessages = 10,
+                # Wait less when there is an up next list so that changes to it are picked up promptly
+                WaitTimeSeconds = min(20, UP_NEXT_INTERVAL) if 'BUCKET_NAME' in os.environ else 20
+            )
+            if len(receive_messages) == 0:
+                logger.info('No messages found. Checking again...')
+            else:
+                process_messages(queue, s3, manifest, executor, receive_messages, up_next)
+            enforce_disk_budget(manifest, up_next)
+
+def list_models(s3, bucket):
+    # List the models in the bucket. The notifications only cover .tar.gz keys so only those are synced. Blobs are synced through their aliases.
+    remote = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket):
+        for o in page.get('Contents', []):
+            if o['Key'].endswith('.tar.gz') and not o['Key'].startswith(BLOB_PREFIX):
+                remote[o['Key']] = {'Size': o['Size'], 'ETag': o['ETag'].strip('"')}
+    return remote
+
+def prefetch(s3, bucket, manifest, executor, up_next):
+    # Download the up next models that are not held locally, including evicted ones, in the order they are needed.
+    # The executor starts tasks in the order they are submitted so the first racer's models are downloaded first.
+    remote = list_models(s3, bucket)
+    keys = up_next.order(remote.keys())
+    manifest.touch(keys)
+    events = OrderedDict()
+    for key in keys:
+        entry = manifest.get(key)
+        if entry is None or entry['ETag'] != remote[key]['ETag']:
+            events[key] = {'bucket': bucket, 'eventName': 'ObjectCreated:Prefetch'}
+    logger.info(f'Prefetching {len(events)} of {len(keys)} up next models.')
+    results = executor.map(lambda item: process_event(s3, manifest, item[0], item[1]), events.items())
+    failed = [key for key, success in zip(events.keys(), results) if not success]
+    logger.info(f'Prefetch complete with {len(failed)} failures.')
+    enforce_disk_budget(manifest, up_next)
+
+def enforce_disk_budget(manifest, up_next):
+    # Evict the least recently used models once the local folder is over the disk budget. Models that share a blob use its space once
+    # and are evicted together. Up next models are never evicted.
+    if DISK_BUDGET <= 0:
+        return
+    files = {}
+    for key, entry in manifest.items():
+        item = files.setdefault(entry['Blob'] or key, {'Size': entry['Size'], 'Used': 0, 'Keys': []})
+        item['Used'] = max(item['Used'], entry['Used'])
+        item['Keys'].append(key)
+    total = sum(item['Size'] for item in files.values())
+    for item in sorted(files.values(), key=lambda i: i['Used']):
+        if total <= DISK_BUDGET:
+            break
+        if len(up_next.order(item['Keys'])) > 0:
+            continue
+        for key in item['Keys']:
+            logger.info(f'Evicting {key} to stay within the disk budget')
+            remove_model(manifest, key, evicted=True)
+        total -= item['Size']
+    if total > DISK_BUDGET:
+        logger.warning(f'Local folder uses {total} bytes, over the disk budget of {DISK_BUDGET} bytes, with only up next models left')
+
+def reconcile(s3, bucket, manifest, executor, up_next):
+    logger.info(f'Reconciling s3://{bucket} with {os.environ["LOCAL_FOLDER"]}...')
+    remote = list_models(s3, bucket)
+    # Drop manifest entries whose file has gone missing or changed size on disk
+    for key in manifest.keys():
+        local_path = f"{os.environ['LOCAL_FOLDER']}/{key}"
+        if not os.path.exists(local_path) or os.path.getsize(local_path) != manifest.get(key)['Size']:
+            logger.info(f'Local file for {key} is missing or has changed.')
+            manifest.remove(key)
+    # Adopt files that are on disk but not in the manifest (e.g. downloaded before the manifest existed) if they match the bucket
+    for root, folders, files in os.walk(os.environ['LOCAL_FOLDER']):
+        folders[:] = [f for f in folders if f != BLOB_FOLDER]
+        for name in files:
+            local_path = os.path.join(root, name)
+            key = os.path.relpath(local_path, os.environ['LOCAL_FOLDER'])
+            if name.endswith('.tar.gz') and manifest.get(key) is None:
+                if key in remote and os.path.getsize(local_path) == remote[key]['Size'] and etag_matches(s3, bucket, key, local_path, remote[key]['ETag']):
+                    manifest.put(key, remote[key]['Size'], remote[key]['ETag'], sha256_file(local_path))
+                elif key not in remote:
+                    # Not in the bucket so make sure the delete below removes it
+                    manifest.put(key, os.path.getsize(local_path), None)
+    # Only the differences are acted on. Evicted models are left out unless they are up next, and up next models go first.
+    events = OrderedDict()
+    for key in up_next.order(remote.keys()) + sorted(remote.keys()):
+        entry = manifest.get(key)
+        if key in events or (manifest.is_evicted(key) and up_next.rank(key) is None):
+            continue
+        if entry is None or entry['ETag'] != remote[key]['ETag']:
+            events[key] = {'bucket': bucket, 'eventName': 'ObjectCreated:Reconcile'}
+    for key in manifest.keys():
+        if key not in remote:
+            events[key] = {'bucket': bucket, 'eventName': 'ObjectRemoved:Reconcile'}
+    logger.info(f'Reconciliation found {len(events)} changes.')
+    results = executor.map(lambda item: process_event(s3, manifest, item[0], item[1]), events.items())
+    failed = [key for key, success in zip(events.keys(), results) if not success]
+    # Remove local blobs that no model refers to any more
+    blob_folder = f"{os.environ['LOCAL_FOLDER']}/{BLOB_FOLDER}"
+    if os.path.exists(blob_folder):
+        for name in os.listdir(blob_folder):
+            if name.endswith('.tar.gz') and not manifest.blob_in_use(f'{BLOB_FOLDER}/{name}'):
+                logger.info(f'Removing unused blob {name}')
+                os.remove(f'{blob_folder}/{name}')
+    logger.info(f'Reconciliation complete with {len(failed)} failures.')
+
+def process_messages(queue, s3, manifest, executor, messages, up_next):
+    # Coalesce the events in the batch so that each key is only acted upon once, using its latest event
+    events = OrderedDict()
+    message_keys = {}
+    for message in messages:
+        body = json.loads(message.body)
+        logger.info(f"Message found: {json.dumps(body)}")
+        message_keys[message.message_id] = set()
+        for record in body.get('Records', []):
+            if 's3' in record:
+                bucket = record['s3']['bucket']['name']
+                # Keys in S3 event notifications are url encoded
+                key = unquote_plus(record['s3']['object']['key'])
+                sequencer = record['s3']['object'].get('sequencer', '')
+                message_keys[message.message_id].add(key)
+                # The sequencer orders events for the same key. It is a hex string so compare it padded to the same length.
+                if key in events and events[key]['sequencer'].rjust(32, '0') > sequencer.rjust(32, '0'):
+                    continue
+                events[key] = {'bucket': bucket, 'eventName': record['eventName'], 'sequencer': sequencer}
+    # Act on each key concurrently, starting with the up next models, and record which ones failed
+    priority = up_next.order(events.keys())
+    events = OrderedDict([(key, events[key]) for key in priority] + [(key, event) for key, event in events.items() if key not in priority])
+    results = executor.map(lambda item: process_event(s3, manifest, item[0], item[1]), events.items())
+    failed = {key for key, success in zip(events.keys(), results) if not success}
+    # Acknowledge every message whose keys were all handled. Failed messages are left on the queue to be retried.
+    entries = [
+        {'Id': message.message_id, 'ReceiptHandle': message.receipt_handle}
+        for message in messages if len(message_keys[message.message_id] & failed) == 0
+    ]
+    if len(entries) > 0:
+        response = queue.delete_messages(Entries=entries)
+        for failure in response.get('Failed', []):
+            logger.error(f"Unable to delete message {failure['Id']}: {failure.get('Message')}")
+
+def process_event(s3, manifest, key, event):
+    local_path = f"{os.environ['LOCAL_FOLDER']}/{key}"
+    # Blobs are only downloaded when an alias refers to them
+    if key.startswith(BLOB_PREFIX):
+        return True
+    try:
+        if event['eventName'].startswith('ObjectCreated'):
+            folder = os.path.dirname(local_path)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            head = s3.head_object(Bucket=event['bucket'], Key=key)
+            blob_key = head['Metadata'].get('blob')
+            if blob_key is None:
+                # Models uploaded before aliases existed hold the model itself
+                logger.info(f'Downloading file to: {local_path}')
+                size, etag = download_file(s3, event['bucket'], key, local_path)
+                manifest.put(key, size, etag, sha256_file(local_path))
+            else:
+                blob = f'{BLOB_FOLDER}/{os.path.basename(blob_key)}'
+                blob_path = f"{os.environ['LOCAL_FOLDER']}/{blob}"
+                with get_blob_lock(blob):
+                    if os.path.exists(blob_path):
+                        logger.info(f'{key} is already held locally as {blob}')
+                    else:
+                        logger.info(f'Downloading {blob_key} to: {blob_path}')
+                        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                        download_file(s3, event['bucket'], blob_key, blob_path)
+                    link_file(blob_path, local_path)
+                    manifest.put(key, os.path.getsize(blob_path), head['ETag'].strip('"'), sha256_file(blob_path), blob)
+        elif event['eventName'].startswith('ObjectRemoved'):
+            remove_model(manifest, key)
+        return True
+    except ClientError as e:
+        # The object was deleted after it was created, and its removal may arrive in a later batch. There is nothing to download
+        # so handle it as a removal rather than leave the message on the queue to fail again.
+        if event['eventName'].startswith('ObjectCreated') and e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            logger.info(f'{key} no longer exists')
+            remove_model(manifest, key)
+            return True
+        logger.error(f'Unable to process {event["eventName"]} for {key}: {e}')
+        return False
+    except Exception as e:
+        logger.error(f'Unable to process {event["eventName"]} for {key}: {e}')
+        return False
+
+def remove_model(manifest, key, evicted=False):
+    local_path = f"{os.environ['LOCAL_FOLDER']}/{key}"
+    logger.info(f'Deleting file from: {local_path}')
+    entry = manifest.get(key)
+    if os.path.exists(local_path):
+        os.remove(local_path)
+    manifest.remove(key, evicted)
+    # Remove the blob once the last model referring to it has gone
+    if entry is not None and entry['Blob'] is not None:
+        with get_blob_lock(entry['Blob']):
+            blob_path = f"{os.environ['LOCAL_FOLDER']}/{entry['Blob']}"
+            if not manifest.blob_in_use(entry['Blob']) and os.path.exists(blob_path):
+                logger.info(f"Removing unused blob {entry['Blob']}")
+                os.remove(blob_path)
+
+def get_blob_lock(blob):
+    with blob_locks_lock:
+        return blob_locks.setdefault(blob, threading.Lock())
+
+def link_file(blob_path, local_path):
+    # Hard link the model name to its blob so the content is held once however many names it has, replacing any existing file atomically
+    if os.path.exists(local_path) and os.path.samefile(blob_path, local_path):
+        return
+    temp_path = f'{local_path}.link'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    os.link(blob_path, temp_path)
+    os.replace(temp_path, local_path)
+
+def download_file(s3, bucket, key, local_path):
+    # Download to a temporary file named after the ETag so that an interrupted download of the same object version can be resumed
+    head = s3.head_object(Bucket=bucket, Key=key)
+    size = head['ContentLength']
+    etag = head['ETag'].strip('"')
+    temp_path = f'{local_path}.{etag}.part'
+    progress_path = f'{temp_path}.done'
+    # Remove partial downloads of any other version of the object
+    for stale_path in glob.glob(f'{glob.escape(local_path)}.*.part*'):
+        if stale_path not in [temp_path, progress_path]:
+            logger.info(f'Removing stale partial download: {stale_path}')
+            os.remove(stale_path)
+    # The progress file records the ranges that have already been written to the temporary file
+    parts = [(start, min(start + PART_SIZE, size) - 1) for start in range(0, size, PART_SIZE)]
+    completed = set()
+    if os.path.exists(temp_path) and os.path.exists(progress_path):
+        with open(progress_path) as f:
+            completed = {int(line) for line in f.read().split()}
+        logger.info(f'Resuming download of {key} with {len(completed)} of {len(parts)} parts already complete')
+    else:
+        with open(temp_path, 'wb') as f:
+            f.truncate(size)
+        open(progress_path, 'w').close()
+    lock = threading.Lock()
+    def download_part(part):
+        start, end = parts[part]
+        # IfMatch ensures every range comes from the same version of the object
+        body = s3.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end}', IfMatch=head['ETag'])['Body']
+        with open(temp_path, 'r+b') as f:
+            f.seek(start)
+            for chunk in body.iter_chunks(1024 * 1024):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        with lock:
+            with open(progress_path, 'a') as f:
+                f.write(f'{part}\n')
+    with ThreadPoolExecutor(max_workers=PART_CONCURRENCY) as executor:
+        # list() so that any exception raised by a part is raised here
+        list(executor.map(download_part, [p for p in range(len(parts)) if p not in completed]))
+    # Verify the download before moving it into place
+    if os.path.getsize(temp_path) != size or not etag_matches(s3, bucket, key, temp_path, etag):
+        os.remove(temp_path)
+        os.remove(progress_path)
+        raise Exception(f'Downloaded file for {key} does not match the size or ETag of the S3 object')
+    os.replace(temp_path, local_path)
+    os.remove(progress_path)
+    logger.info(f'Download of {key} verified and complete')
+    return size, etag
+
+def etag_matches(s3, bucket, key, path, etag):
+    # A multipart ETag is the MD5 of the concatenated part MD5s followed by the part count, so the part size used by the uploader is needed
+    if '-' in etag:
+        part_size = s3.head_object(Bucket=bucket, Key=key, PartNumber=1)['ContentLength']
+        digests = b''
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(part_size), b''):
+                digests += hashlib.md5(chunk).digest()
+        local_etag = f"{hashlib.md5(digests).hexdigest()}-{etag.split('-')[1]}"
+    else:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+        local_etag = md5.hexdigest()
+    if local_etag != etag:
+        logger.error(f'ETag mismatch for {key}: expected {etag}, calculated {local_etag}')
+    return local_etag == etag
+
+def sha256_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
 long_poll_queue()
 